@@ -26,11 +26,30 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 from subprocess import PIPE, Popen, check_output
+from distutils.spawn import find_executable
 import logging
 import copy
+import os
 import weakref
 from functools import wraps
 import re
+import pickle
+import threading
+import collections
+import time
+from cStringIO import StringIO
+try:
+    import z3 as _z3
+except ImportError:
+    _z3 = None
+try:
+    import concurrent.futures as _futures
+except ImportError:
+    _futures = None
+try:
+    import resource as _resource
+except ImportError:
+    _resource = None
 
 import logging
 logger = logging.getLogger("SMT")
@@ -41,10 +60,32 @@ logging.basicConfig(
     level = logging.DEBUG
 )
 
+def _pinned(x):
+    ''' The constant the constraints of its solver pin x to, else x itself.
+        A term built from it only holds in states that keep the constraint,
+        as any term built after a concretization.
+    '''
+    if isinstance(x, BitVec):
+        solver = x.solver
+        if solver is not None and x._value in solver._bounds:
+            lo, hi = solver._bounds[x._value]
+            if lo == hi:
+                return _bvconst(x.size, lo, solver)
+    return x
+
 def goaux_bv(old_method):
     @wraps(old_method)
     def new_method(self, *args, **kw_args):
-        bv = old_method(self, *args, **kw_args)
+        bv = old_method(_pinned(self), *map(_pinned, args), **kw_args)
+        if not isinstance(bv, Symbol):
+            #folded to a python constant (a ^ a, a pinned operand...)
+            return bv
+        if isinstance(bv, BitVec) and bv._range is not None and bv._range[0] == bv._range[1]:
+            #a single value by construction, no need to ask the engine
+            return bv._range[0]
+        solver = self.solver
+        if solver is not None and solver.lazy_simplify and len(bv.value) <= solver.lazy_simplify_size:
+            return bv
         try:
             bv = self.solver.simplify(bv)
         except Exception,e:
@@ -57,16 +98,14 @@ def goaux_bv(old_method):
             pass
         
         if isinstance(bv, Symbol) and len(str(bv.value))>200 and self.solver is not None:
-            aux = self.solver.mkBitVec(bv.size)
-            self.solver.add(aux == bv)
-            return aux
+            return self.solver._mkaux(bv)
         return bv
     return new_method
 
 def goaux_bool(old_method):
     @wraps(old_method)
     def new_method(self, *args, **kw_args):
-        b = old_method(self, *args, **kw_args)
+        b = old_method(_pinned(self), *map(_pinned, args), **kw_args)
         if False and self.solver is not None:
             aux = self.solver.mkBool()
             self.solver.add(aux == b)
@@ -75,34 +114,206 @@ def goaux_bool(old_method):
     return new_method
 
 
+def _auxdeps(symbols, deps=None):
+    ''' Merges the auxiliary symbols referenced by symbols into deps.
+        Dependency dicts are never modified once built so they are shared
+        between expressions whenever possible.
+    '''
+    for x in symbols:
+        if x._isaux:
+            extra = {x._value: x}
+        else:
+            extra = x._aux
+        if not extra or extra is deps:
+            continue
+        if not deps:
+            deps = extra
+        elif any(name not in deps for name in extra):
+            deps = dict(deps)
+            deps.update(extra)
+    return deps
+
+#bounds analysis
+def _constant(text):
+    ''' The value of a bitvector literal, None if text is not one '''
+    if text.startswith('#x'):
+        return int(text[2:], 16)
+    if text.startswith('#b'):
+        return int(text[2:], 2)
+    return None
+
+def _normfacts(size, lo, hi, zeros, ones):
+    ''' Makes an interval and a known bits pair agree with each other '''
+    mask = (1<<size)-1
+    lo = max(lo, ones)
+    hi = min(hi, mask & ~zeros)
+    if lo > hi:
+        return lo, hi, zeros, ones
+    #the bits above the highest one where lo and hi differ are fixed
+    fixed = mask & ~((1<<(lo ^ hi).bit_length())-1)
+    return lo, hi, zeros | (fixed & ~lo), ones | (fixed & lo)
+
+def _facts(x):
+    ''' (lo, hi, zeros, ones) that hold for a BitVec whatever the constraints '''
+    lo, hi = x._range or (0, (1<<x.size)-1)
+    zeros, ones = x._known or (0, 0)
+    return lo, hi, zeros, ones
+
+def _bvfacts(size, op, children):
+    ''' Propagates the facts of the children through op, None if unknown '''
+    mask = (1<<size)-1
+    if op == 'ite':
+        a, b = _facts(children[1]), _facts(children[2])
+        return min(a[0], b[0]), max(a[1], b[1]), a[2] & b[2], a[3] & b[3]
+    if op.startswith('(_ zero_extend'):
+        lo, hi, zeros, ones = _facts(children[0])
+        return lo, hi, zeros | (mask ^ ((1<<children[0].size)-1)), ones
+    if op.startswith('(_ extract'):
+        top, bottom = map(int, op[:-1].split()[2:])
+        lo, hi, zeros, ones = _facts(children[0])
+        if hi >> (top+1):
+            lo, hi = 0, mask
+        else:
+            lo, hi = lo >> bottom, hi >> bottom
+        return lo, hi, (zeros >> bottom) & mask, (ones >> bottom) & mask
+    if op == 'concat':
+        lo = hi = zeros = ones = 0
+        for x in children:
+            l, h, z, o = _facts(x)
+            lo, hi = (lo << x.size) | l, (hi << x.size) | h
+            zeros, ones = (zeros << x.size) | z, (ones << x.size) | o
+        return lo, hi, zeros, ones
+    if op == 'bvnot':
+        lo, hi, zeros, ones = _facts(children[0])
+        return mask-hi, mask-lo, ones, zeros
+    if op not in _bv_ops or len(children) != 2:
+        return None
+    l1, h1, z1, o1 = _facts(children[0])
+    l2, h2, z2, o2 = _facts(children[1])
+    if op == 'bvand':
+        return 0, min(h1, h2), z1 | z2, o1 & o2
+    if op == 'bvor':
+        return max(l1, l2), mask, z1 & z2, o1 | o2
+    if op == 'bvxor':
+        return 0, mask, (z1 & z2) | (o1 & o2), (z1 & o2) | (o1 & z2)
+    if op == 'bvadd' and h1 + h2 <= mask:
+        return l1 + l2, h1 + h2, 0, 0
+    if op == 'bvsub' and l1 >= h2:
+        return l1 - h2, h1 - l2, 0, 0
+    if op == 'bvmul' and h1 * h2 <= mask:
+        return l1 * l2, h1 * h2, 0, 0
+    if op == 'bvudiv' and l2 > 0:
+        return l1 // h2, h1 // l2, 0, 0
+    if op == 'bvurem' and l2 > 0:
+        return 0, min(h1, h2 - 1), 0, 0
+    if l2 != h2:
+        return None
+    #shifts by a constant amount
+    if op == 'bvlshr':
+        if l2 >= size:
+            return 0, 0, mask, 0
+        return l1 >> l2, h1 >> l2, (z1 >> l2) | (mask ^ (mask >> l2)), o1 >> l2
+    if op == 'bvshl':
+        if l2 >= size:
+            return 0, 0, mask, 0
+        zeros, ones = ((z1 << l2) | ((1<<l2)-1)) & mask, (o1 << l2) & mask
+        if h1 << l2 <= mask:
+            return l1 << l2, h1 << l2, zeros, ones
+        return 0, mask, zeros, ones
+    return None
+
+def _bounds(x, size):
+    ''' The unsigned interval of a BitVec or an integer '''
+    if isinstance(x, BitVec):
+        return x.bounds
+    x &= (1<<size)-1
+    return x, x
+
+def _decide(op, a, b):
+    ''' Folds the unsigned comparison op between a and b to a python bool
+        when their intervals already decide it, None otherwise.
+    '''
+    size = a.size if isinstance(a, BitVec) else b.size
+    la, ha = _bounds(a, size)
+    lb, hb = _bounds(b, size)
+    if op == 'ult':
+        op, la, ha, lb, hb = 'ugt', lb, hb, la, ha
+    elif op == 'ule':
+        op, la, ha, lb, hb = 'uge', lb, hb, la, ha
+    if op == 'ugt':
+        if la > hb:
+            return True
+        if ha <= lb:
+            return False
+    else:
+        if la >= hb:
+            return True
+        if ha < lb:
+            return False
+    return None
+
+def _noref():
+    return None
+
+def _ref(solver):
+    ''' The back-reference a symbol keeps to its solver. A weakref without
+        callback is shared by every symbol of the same solver.
+    '''
+    if solver is None:
+        return _noref
+    return weakref.ref(solver)
+
+#constants of symbols without a solver, (size, value) -> BitVec
+_constants = weakref.WeakValueDictionary()
+
+def _bvconst(size, value, solver=None):
+    ''' The constant BitVec of size bits holding value. Constants are
+        interned per solver so repeated operands share one node and text.
+    '''
+    value &= (1<<size)-1
+    table = _constants if solver is None else solver._constants
+    bv = table.get((size, value))
+    if bv is None:
+        if size == 1:
+            bv = BitVec(size, '#b%d'%value, solver=solver)
+        else:
+            bv = BitVec(size, '#x%0*x'%(size/4, value), solver=solver)
+        table[(size, value)] = bv
+    return bv
+
 class Symbol(object):
+    #long runs hold millions of these, no __dict__
+    __slots__ = ('_solver', '_value', '_aux', '_isaux', '__weakref__')
+
     def __init__(self, value, *children, **kwargs):
         assert type(value) in [int,long,str,bool]
         assert all([ isinstance(x, Symbol) for x in children])
-        solver = kwargs.get('solver',None)
-        if solver is not None:
-            self._solver = weakref.ref(kwargs['solver'])
-        else:
-            self._solver = lambda: None
+        self._solver = _ref(kwargs.get('solver',None))
 
         if len(children) > 0:
             self._value = '('+ str(value) +' '+ ' '.join(map(str, children)) +')'
         else:
             self._value = str(value)
 
+        #auxiliary symbols (name -> symbol) this expression refers to
+        self._aux = _auxdeps(children, kwargs.get('aux', None)) or None
+        self._isaux = False
+
     def __getstate__(self):
         state = {}
         state['solver'] = self.solver
         state['value'] = self.value
+        if self._aux:
+            state['aux'] = self._aux
+        if self._isaux:
+            state['isaux'] = True
         return state
 
     def __setstate__(self, state):
-        solver = state['solver']
-        if solver is not None:
-            self._solver = weakref.ref(solver)
-        else:
-            self._solver = lambda: None
+        self._solver = _ref(state['solver'])
         self._value = state['value']
+        self._aux = state.get('aux', None)
+        self._isaux = 'isaux' in state
 
     @property
     def solver(self):
@@ -117,29 +328,66 @@ class Symbol(object):
 
 class BitVec(Symbol):
     ''' A symbolic bitvector '''
+    __slots__ = ('size', '_range', '_known')
+
     def __init__(self, size, value, *children, **kwargs):
         super(BitVec,self).__init__(value, *children, **kwargs)
         assert size in [1,8,16,32,64,128,256]
         self.size=size
+        #unsigned (lo, hi) interval and (zeros, ones) masks of the bits known
+        #to hold by construction, None when nothing is known
+        self._range = None
+        self._known = None
+        if children:
+            facts = _bvfacts(size, value, children)
+        else:
+            c = _constant(self._value)
+            facts = None if c is None else (c, c, ((1<<size)-1) & ~c, c)
+        if facts is not None:
+            self._setfacts(*facts)
+
+    def _setfacts(self, lo, hi, zeros, ones):
+        mask = (1<<self.size)-1
+        lo, hi, zeros, ones = _normfacts(self.size, lo, hi, zeros, ones)
+        if (lo, hi) != (0, mask):
+            self._range = (lo, hi)
+        if zeros or ones:
+            self._known = (zeros, ones)
+
+    @property
+    def bounds(self):
+        ''' The unsigned (min, max) interval the value is known to lie in,
+            refined by the simple constraints asserted in the solver.
+        '''
+        lo, hi = self._range or (0, (1<<self.size)-1)
+        solver = self.solver
+        if solver is not None and self._value in solver._bounds:
+            l, h = solver._bounds[self._value]
+            lo, hi = max(lo, l), min(hi, h)
+        return lo, hi
 
     def __getstate__(self):
         state = super(BitVec, self).__getstate__()
         state['size'] = self.size
+        if self._range is not None:
+            state['range'] = self._range
+        if self._known is not None:
+            state['known'] = self._known
         return state
     def __setstate__(self, state):
         super(BitVec, self).__setstate__(state)
         self.size = state['size']
+        self._range = state.get('range', None)
+        self._known = state.get('known', None)
 
     def cast(self, val):
         if type(val) in (int,long):
-            if self.size == 1:
-                return BitVec(self.size, '#'+bin(val&1)[1:], solver=self.solver)
-            return BitVec(self.size, '#x%0*x'%(self.size/4, val&((1<<self.size)-1)), solver=self.solver)
+            return _bvconst(self.size, val, self.solver)
         elif type(val) is Bool:
             raise NotImplemented()
         elif type(val) is str:
             assert len(val) == 1 and self.size==8
-            return BitVec(self.size, '#x%02x'%ord(val), solver=self.solver)
+            return _bvconst(self.size, ord(val), self.solver)
         assert type(val) == BitVec and val.size == self.size
         return val
 
@@ -345,6 +593,8 @@ class BitVec(Symbol):
 
 #Booleans
 class Bool(Symbol):
+    __slots__ = ()
+
     def __init__(self, value, *children, **kwargs):
         super(Bool,self).__init__(value, *children, **kwargs)
 
@@ -400,6 +650,8 @@ class Bool(Symbol):
 
 #array
 class Array_(Symbol):
+    __slots__ = ('size',)
+
     def __init__(self, size, value, *children, **kwargs):
         super(Array_,self).__init__(value, *children, **kwargs)
         self.size=size
@@ -415,24 +667,24 @@ class Array_(Symbol):
 
     def cast_key(self, val):
         if type(val) in (int,long):
-            return BitVec(self.size, '#x%0*x'%(self.size/4, val&((1<<self.size)-1)), solver=self.solver)
+            return _bvconst(self.size, val, self.solver)
         elif type(val) is Bool:
             raise NotImplemented()
         elif type(val) is str:
             assert len(val) == 1 and self.size==8
-            return BitVec(self.size, '#x%02x'%ord(val), solver=self.solver)
+            return _bvconst(self.size, ord(val), self.solver)
 
         assert type(val) == BitVec and val.size == self.size
         return val
 
     def cast_value(self, val):
         if type(val) in (int,long):
-            return BitVec(8, '#x%02x'%(val&((1<<self.size)-1)), solver=self.solver)
+            return _bvconst(8, val, self.solver)
         elif type(val) is Bool:
             raise NotImplemented()
         elif type(val) is str:
             assert len(val) == 1
-            return BitVec(8, '#x%02x'%ord(val), solver=self.solver)
+            return _bvconst(8, ord(val), self.solver)
         assert type(val) == BitVec and val.size == 8
         return val
 
@@ -441,17 +693,23 @@ class Array_(Symbol):
         return BitVec(8, 'select', self, self.cast_key(key), solver=self.solver)
 
     def store(self, key, value):
-        return Array_(self.size, '(store %s %s %s)'%( self, self.cast_key(key), self.cast_value(value)), solver=self.solver)
+        return Array_(self.size, 'store', self, self.cast_key(key), self.cast_value(value), solver=self.solver)
 
     def __eq__(self, other):
         assert isinstance(other, Array_) and other.size == self.size
         return Bool('=', self, other, solver=self.solver)
 
 class Array(object):
+    #symbolic reads over at most this many addresses may become an ite chain
+    ite_limit = 16
+
     def __init__(self, size, name, *children, **kwargs):
         self.array = Array_(size, name, *children, **kwargs)
         self.name = name
         self.cache = {}
+        self.stores = 0
+        #how many symbolic reads went through each strategy
+        self.stats = {'select': 0, 'ite': 0, 'concretize': 0}
         self.declaration = '(declare-fun %s () (Array (_ BitVec %d) (_ BitVec 8)))'%(name, size)
 
     def __getstate__(self):
@@ -460,18 +718,74 @@ class Array(object):
         state['array'] = self.array
         state['name'] = self.name
         state['cache'] = self.cache
+        state['stores'] = self.stores
+        state['stats'] = self.stats
         return state
 
     def __setstate__(self, state):
         self.array = state['array']
         self.name = state['name']
         self.cache = state['cache']
+        self.stores = state['stores']
+        self.stats = state['stats']
         self.declaration = state['declaration']
 
+    def _cachekey(self, key):
+        ''' Concrete keys are cached by value, symbolic ones by their text '''
+        if isinstance(key, BitVec):
+            c = _constant(key.value)
+            return key.value if c is None else c
+        if isinstance(key, str):
+            return _ord(key)
+        return key & ((1<<self.array.size)-1)
+
     def __getitem__(self, key):
-        if key not in self.cache:
-            self.cache[key] = self.array.select(key)
-        return self.cache[key]
+        k = self._cachekey(key)
+        if k in self.cache:
+            return self.cache[k]
+        if not isinstance(k, str):
+            self.cache[k] = self.array.select(key)
+            return self.cache[k]
+        lo, hi = key.bounds
+        strategy = self.read_strategy(key, lo, hi)
+        if strategy not in self.stats:
+            raise Exception("Unknown read strategy %r"%(strategy,))
+        self.stats[strategy] += 1
+        if strategy == 'concretize':
+            return self[lo]
+        if strategy == 'ite':
+            #the interval is sound so the last candidate needs no test
+            value = self[hi]
+            for address in xrange(hi-1, lo-1, -1):
+                value = ITEBV(8, key == address, self[address], value)
+            #it may depend on constraints that a pop removes, do not cache it
+            return value
+        self.cache[k] = self.array.select(key)
+        return self.cache[k]
+
+    def read_strategy(self, key, lo, hi):
+        ''' Picks how a symbolic key with feasible values in [lo, hi] is
+            read: 'select', 'ite' or 'concretize'. A key with a single value
+            is concretized. A select over a long store chain costs the engine
+            about as much as the chain, so few enough candidate addresses are
+            expanded to an ite chain instead. Override to change the policy.
+        '''
+        count = hi - lo + 1
+        if count == 1:
+            return 'concretize'
+        if count <= self.ite_limit and count <= self.stores:
+            return 'ite'
+        return 'select'
+
+    def _invalidate(self, keys):
+        ''' Drops the cached reads a write to keys may have changed '''
+        if any(isinstance(k, str) for k in keys):
+            #a symbolic key may alias anything
+            self.cache = {}
+            return
+        for k in self.cache.keys():
+            if isinstance(k, str) or k in keys:
+                del self.cache[k]
 
     def __setitem__(self, key, value):
         new_arr = self.array.store(key,value)
@@ -479,39 +793,675 @@ class Array(object):
         #    aux = self.array.solver.mkArray(self.array.size).array
         #    self.array.solver.add(aux == new_arr)
         #    new_arr = aux
-        self.cache = {}
+        k = self._cachekey(key)
+        self._invalidate((k,))
         self.array = new_arr
+        self.stores += 1
+        self.cache[k] = self.array.cast_value(value)
+
+    def _addresses(self, addr, nbytes):
+        if isinstance(addr, BitVec):
+            #plain terms, not worth a simplify round trip each
+            return [addr] + [BitVec(addr.size, 'bvadd', addr, addr.cast(i), solver=addr.solver)
+                             for i in range(1, nbytes)]
+        return [(addr + i) & ((1<<self.array.size)-1) for i in range(nbytes)]
+
+    def read(self, addr, nbytes, endian='little'):
+        ''' Reads nbytes starting at addr as a single nbytes*8 bits value.
+            Returns an int if every byte is known.
+            @param endian: 'little' or 'big'
+        '''
+        assert endian in ('little', 'big')
+        values = [self[a] for a in self._addresses(addr, nbytes)]
+        if endian == 'little':
+            values.reverse()
+        concrete = [v if isinstance(v, (int, long)) else _constant(v.value) for v in values]
+        if None not in concrete:
+            return CONCAT(8, *concrete)
+        return CONCAT(8, *values)
+
+    def write(self, addr, value, nbytes, endian='little'):
+        ''' Writes the nbytes*8 bits value (an int or a BitVec) to the
+            nbytes starting at addr.
+            @param endian: 'little' or 'big'
+        '''
+        assert endian in ('little', 'big')
+        assert isinstance(value, (int, long)) or value.size == nbytes*8
+        addresses = self._addresses(addr, nbytes)
+        if endian == 'big':
+            addresses.reverse()
+        array = self.array
+        values = []
+        for i, a in enumerate(addresses):
+            byte = array.cast_value(EXTRACT(value, 8*i, 8))
+            array = array.store(a, byte)
+            values.append(byte)
+        keys = map(self._cachekey, addresses)
+        self._invalidate(keys)
+        self.array = array
+        self.stores += nbytes
+        for k, byte in zip(keys, values):
+            self.cache[k] = byte
+
+#term sharing
+_token = re.compile(r'\(|\)|\|[^|]*\||"(?:[^"]|"")*"|[^\s()|";]+')
+_bool_ops = frozenset(['=', 'distinct', 'not', 'and', 'or', 'xor', '=>',
+                       'bvult', 'bvule', 'bvugt', 'bvuge',
+                       'bvslt', 'bvsle', 'bvsgt', 'bvsge'])
+_bv_ops = frozenset(['bvadd', 'bvsub', 'bvmul', 'bvudiv', 'bvurem', 'bvsdiv',
+                     'bvsrem', 'bvsmod', 'bvshl', 'bvlshr', 'bvashr', 'bvand',
+                     'bvor', 'bvxor', 'bvnand', 'bvnor', 'bvxnor', 'bvnot',
+                     'bvneg'])
+
+def _sortname(sort):
+    if sort == 'Bool':
+        return 'Bool'
+    if isinstance(sort, tuple):
+        return '(Array %s %s)'%(_sortname(sort[1]), _sortname(sort[2]))
+    return '(_ BitVec %d)'%sort
+
+class SharedTerms(object):
+    ''' Rewrites outgoing commands so that big subterms travel to the engine
+        only once, as a define-fun, and are referenced by name afterwards.
+        Every term sent is hash-consed. A subterm of at least min_size bytes
+        gets a name when it appears twice in the same command or reappears
+        in a later one. Names follow the engine assertion stack.
+    '''
+    commands = ('assert', 'simplify')
+
+    def __init__(self, min_size=64, max_nodes=1000000):
+        self.min_size = min_size
+        self.max_nodes = max_nodes
+        self._count = 0
+        self.clear()
+
+    def clear(self):
+        ''' Forgets everything. The engine must have forgotten too. '''
+        self._nodes = {}    # items -> node id
+        self._info = []     # node id -> (items, size, sort)
+        self._names = {}    # node id -> defined name
+        self._trail = []    # node ids in definition order
+        self._marks = []
+
+    def push(self):
+        self._marks.append((len(self._trail), len(self._info)))
+
+    def pop(self):
+        if not self._marks:
+            return
+        trail, nodes = self._marks.pop()
+        #names and terms may refer to symbols that are now out of scope
+        for n in self._trail[trail:]:
+            self._names.pop(n, None)
+        del self._trail[trail:]
+        for items, _, _ in self._info[nodes:]:
+            del self._nodes[items]
+        del self._info[nodes:]
+
+    def _atomsort(self, atom, sortof):
+        if atom.startswith('#x'):
+            return 4*(len(atom)-2)
+        if atom.startswith('#b'):
+            return len(atom)-2
+        if atom in ('true', 'false'):
+            return 'Bool'
+        return sortof(atom)
+
+    def _sort(self, items, sortof):
+        ''' Infers the sort of a term, None if unknown or not a term '''
+        if not items:
+            return None
+        head = items[0]
+        args = [self._info[x][2] if type(x) is int else self._atomsort(x, sortof) for x in items[1:]]
+        try:
+            if type(head) is int:
+                #indexed operator ((_ extract 7 0) x)
+                index = self._info[head][0]
+                if index[0] != '_' or len(args) != 1 or not isinstance(args[0], int):
+                    return None
+                op, params = index[1], map(int, index[2:])
+                if op == 'extract':
+                    return params[0] - params[1] + 1
+                if op in ('zero_extend', 'sign_extend'):
+                    return args[0] + params[0]
+                if op == 'repeat':
+                    return args[0] * params[0]
+                if op in ('rotate_left', 'rotate_right'):
+                    return args[0]
+                return None
+            if head == '_':
+                #bitvector literal (_ bv10 32)
+                if len(items) == 3 and items[1].startswith('bv'):
+                    return int(items[2])
+                return None
+        except (ValueError, IndexError, TypeError):
+            return None
+        if head in _bool_ops:
+            return 'Bool'
+        if head in _bv_ops or head == 'store':
+            return args[0] if args else None
+        if head == 'ite':
+            return args[1] if len(args) == 3 else None
+        if head == 'concat':
+            if args and all(isinstance(a, int) for a in args):
+                return sum(args)
+            return None
+        if head == 'bvcomp':
+            return 1
+        if head == 'select':
+            if len(args) == 2 and isinstance(args[0], tuple):
+                return args[0][2]
+        return None
+
+    def _intern(self, items, sortof):
+        n = self._nodes.get(items)
+        if n is None:
+            n = len(self._info)
+            size = len(items) + 1
+            for x in items:
+                size += self._info[x][1] if type(x) is int else len(x)
+            self._nodes[items] = n
+            self._info.append((items, size, self._sort(items, sortof)))
+        return n
+
+    def _parse(self, text, sortof):
+        ''' Returns the top level forms of text and how many times each
+            term appears in it. '''
+        counts = {}
+        stack = [[]]
+        for tok in _token.findall(text):
+            if tok == '(':
+                stack.append([])
+            elif tok == ')':
+                n = self._intern(tuple(stack.pop()), sortof)
+                counts[n] = counts.get(n, 0) + 1
+                stack[-1].append(n)
+            else:
+                stack[-1].append(tok)
+        if len(stack) != 1:
+            raise ValueError("Unbalanced smtlib")
+        return stack[0], counts
+
+    def _flat(self, x, raw=False):
+        ''' Serializes a term using the names already defined, except under
+            a let where names may be shadowed. '''
+        out = []
+        todo = [(x, raw)]
+        while todo:
+            x, raw = todo.pop()
+            if type(x) is not int:
+                out.append(x)
+                continue
+            if not raw and x in self._names:
+                out.append(self._names[x])
+                continue
+            items = self._info[x][0]
+            raw = raw or (len(items) > 0 and items[0] == 'let')
+            out.append('(')
+            todo.append((')', raw))
+            for i in xrange(len(items)-1, -1, -1):
+                todo.append((items[i], raw))
+                if i:
+                    todo.append((' ', raw))
+        return ''.join(out)
+
+    def rewrite(self, text, sortof):
+        ''' Returns the text to send in place of text: the define-fun
+            commands for the new shared subterms followed by the original
+            commands referencing them.
+            @param sortof: maps a declared symbol name to its sort
+        '''
+        if len(self._info) > self.max_nodes:
+            #start over, but pops must still drop what is defined from now on
+            depth = len(self._marks)
+            self.clear()
+            self._marks = [(0, 0)] * depth
+        first = len(self._info)
+        try:
+            forms, counts = self._parse(text, sortof)
+        except ValueError:
+            return text
+
+        #pick the terms worth naming, children before parents. Each form
+        #gets its new definitions right before it: the symbols they use may
+        #be declared by an earlier form of the same text
+        out = []
+        named = False
+        seen = set()
+        for form in forms:
+            if type(form) is not int:
+                out.append(form)
+                continue
+            items = self._info[form][0]
+            command = items and items[0] in self.commands
+            order = []
+            todo = [(x, False) for x in items[1:]] if command else []
+            while todo:
+                n, done = todo.pop()
+                if done:
+                    order.append(n)
+                    continue
+                if type(n) is not int or n in seen:
+                    continue
+                seen.add(n)
+                if n in self._names:
+                    named = True
+                    continue
+                items, size, sort = self._info[n]
+                if items and items[0] == 'let':
+                    continue
+                if size >= self.min_size and sort is not None and \
+                   (n < first or counts[n] > 1):
+                    todo.append((n, True))
+                todo.extend((x, False) for x in items)
+            for n in order:
+                body = self._flat(n)
+                self._count += 1
+                name = 'share!%d'%self._count
+                self._names[n] = name
+                self._trail.append(n)
+                out.append('(define-fun %s () %s %s)'%(name, _sortname(self._info[n][2]), body))
+            named = named or bool(order)
+            out.append(self._flat(form, not command))
+
+        if not named:
+            return text
+        return '\n'.join(out)
+
+#backends
+class Backend(object):
+    ''' The way a Solver talks to an actual engine.
+        A backend starts and stops the engine, sends it SMTLIBv2 commands and
+        reads back its responses one balanced s-expression at a time.
+    '''
+    def __init__(self, config):
+        self._config = config
+
+    @staticmethod
+    def identity(config):
+        ''' Something that changes whenever the engine behind config is
+            replaced, or None if it can not be told.
+        '''
+        return None
+
+    def start(self):
+        raise NotImplementedError()
+
+    def stop(self):
+        raise NotImplementedError()
+
+    def alive(self):
+        ''' False if the engine went away (crashed, killed or stopped) '''
+        raise NotImplementedError()
+
+    def rss(self):
+        ''' Resident memory of the engine in bytes, None if it can not be told '''
+        return None
+
+    def send(self, cmd):
+        ''' Send a SMTLIBv2 command (a string) to the engine. '''
+        raise NotImplementedError()
+
+    def _readline(self):
+        raise NotImplementedError()
+
+    def recv(self):
+        ''' Reads one response (possibly spanning several lines) '''
+        bufl = []
+        left = 0
+        right = 0
+        buf = self._readline()
+        bufl.append(buf)
+        left += buf.count('(')
+        right += buf.count(')')
+        while left != right:
+            buf = self._readline()
+            if not buf:
+                #the engine is gone or has nothing more to say
+                break
+            bufl.append(buf)
+            left += buf.count('(')
+            right += buf.count(')')
+        return ''.join(bufl).strip()
+
+class SubprocessBackend(Backend):
+    ''' An engine running in a child process, fed through a text pipe. '''
+    #resource limits set on the child, {resource.RLIMIT_AS: (soft, hard)}.
+    #A 'limits' entry in the engine config takes precedence.
+    limits = None
+
+    def __init__(self, config):
+        super(SubprocessBackend, self).__init__(config)
+        self._proc = None
+
+    @staticmethod
+    def identity(config):
+        path = find_executable(config['command'].split()[0])
+        if path is None:
+            return None
+        path = os.path.realpath(path)
+        return path, os.path.getmtime(path)
+
+    def start(self):
+        limits = self._config.get('limits', self.limits)
+        if limits and _resource is None:
+            raise Exception("engine limits need the resource module")
+        def setlimits():
+            for which, limit in limits.iteritems():
+                _resource.setrlimit(which, limit)
+        #buffered both ways, commands are flushed when a response is needed
+        self._proc = Popen(self._config['command'], shell=True, stdin=PIPE, stdout=PIPE, bufsize=-1,
+                           preexec_fn=setlimits if limits else None)        #'stp --SMTLIB2'
+
+    def stop(self):
+        #self.send('(quit)')
+        if self._proc.poll() is None:
+            self._proc.kill()
+        self._proc.wait()
+        try:
+            self._proc.stdin.close()
+        except IOError:
+            #what was still buffered has nowhere to go
+            pass
+        self._proc.stdout.close()
+        self._proc = None
+
+    def alive(self):
+        return self._proc is not None and self._proc.poll() is None
+
+    def rss(self):
+        ''' Sums the child and its descendants (the shell, wrappers...) as
+            listed in /proc. None where there is no /proc.
+        '''
+        if self._proc is None:
+            return None
+        pages = 0
+        pids = [self._proc.pid]
+        try:
+            while pids:
+                pid = pids.pop()
+                with open('/proc/%d/statm'%pid) as f:
+                    pages += int(f.read().split()[1])
+                try:
+                    with open('/proc/%d/task/%d/children'%(pid, pid)) as f:
+                        pids.extend(int(child) for child in f.read().split())
+                except IOError:
+                    #kernel without CONFIG_PROC_CHILDREN, the child alone
+                    pass
+        except (IOError, OSError, ValueError):
+            if not pages:
+                return None
+        return pages * os.sysconf('SC_PAGE_SIZE')
+
+    def send(self, cmd):
+        self._proc.stdin.writelines((cmd,'\n'))
+
+    def _readline(self):
+        try:
+            self._proc.stdin.flush()
+        except IOError:
+            #the engine is gone, recv tells by reading nothing
+            return ''
+        return self._proc.stdout.readline()
+
+class Z3Backend(Backend):
+    ''' The z3 engine loaded in-process through its native library.
+        Commands are evaluated directly on a z3 context so there is no child
+        process and no pipe in the way. Needs the z3 python bindings.
+        Terms are still handed over as SMTLIBv2 text: symbols only exist as
+        text in this library so z3 has to parse them either way. What this
+        saves is the pipe round-trip and the process, not the printing and
+        parsing of the commands.
+    '''
+    def __init__(self, config):
+        super(Z3Backend, self).__init__(config)
+        self._ctx = None
+        self._lines = collections.deque()
+
+    @staticmethod
+    def identity(config):
+        if _z3 is None:
+            return None
+        path = os.path.realpath(_z3.z3core.__file__)
+        return path, os.path.getmtime(path), _z3.get_full_version()
+
+    def start(self):
+        if _z3 is None:
+            raise Exception("z3 python bindings not found")
+        #z3 reads its global parameters when the context first evaluates
+        params = self._config.get('params', {})
+        saved = dict((name, _z3.get_param(name)) for name in params)
+        _z3.set_param(**params)
+        try:
+            self._ctx = _z3.Context()
+            _z3.Z3_eval_smtlib2_string(self._ctx.ref(), '')
+        finally:
+            _z3.set_param(**saved)
+        self._lines.clear()
+
+    def stop(self):
+        self._ctx = None
+        self._lines.clear()
+
+    def alive(self):
+        return self._ctx is not None
+
+    def send(self, cmd):
+        try:
+            output = _z3.Z3_eval_smtlib2_string(self._ctx.ref(), cmd)
+        except _z3.Z3Exception, e:
+            #the error sticks to the context until cleared
+            _z3.Z3_set_error(self._ctx.ref(), _z3.Z3_OK)
+            output = e.value
+        self._lines.extend(output.splitlines(True))
+
+    def _readline(self):
+        if not self._lines:
+            return ''
+        return self._lines.popleft()
 
 #solver
+class _Constraints(object):
+    ''' The assertions of a solver state. They iterate in the order they
+        were added and two assertions of the same text are kept once.
+    '''
+    def __init__(self, constraints=()):
+        self._bytext = {}
+        self._order = []
+        for c in constraints:
+            self.add(c)
+
+    def add(self, c):
+        if c.value not in self._bytext:
+            self._bytext[c.value] = c
+            self._order.append(c)
+
+    def discard(self, c):
+        if self._bytext.get(c.value) is c:
+            del self._bytext[c.value]
+            #dropped from the order lazily
+            if len(self._order) > 2*len(self._bytext):
+                self._order = list(self)
+
+    def __contains__(self, c):
+        return c.value in self._bytext
+
+    def hastext(self, text):
+        return text in self._bytext
+
+    def __iter__(self):
+        bytext = self._bytext
+        return (c for c in self._order if bytext.get(c.value) is c)
+
+    def __len__(self):
+        return len(self._bytext)
+
+    def __copy__(self):
+        other = _Constraints()
+        other._bytext = dict(self._bytext)
+        other._order = list(self._order)
+        return other
+
+    #built after its symbols when unpickling, as a set would be; the texts
+    #go along as the symbols may still be half restored then
+    def __reduce__(self):
+        return (_restore_constraints, ([(c.value, c) for c in self],))
+
+def _restore_constraints(pairs):
+    constraints = _Constraints()
+    constraints._bytext = dict(pairs)
+    constraints._order = [c for text, c in pairs]
+    return constraints
+
+#logics from the narrowest and the theories they cover, (A)rrays and (BV)
+_logics = [('QF_UF', frozenset()),
+           ('QF_BV', frozenset(['BV'])),
+           ('QF_ABV', frozenset(['A', 'BV']))]
+
+#functions z3 only knows internally
+_internal = re.compile(r'\bbv\w+_i\b')
+
+def _theories(text):
+    ''' The theories some smtlib text refers to '''
+    if '(select' in text or '(store' in text or '(as const' in text or '(Array' in text:
+        return frozenset(['A', 'BV'])
+    if '#x' in text or '#b' in text or '(_ ' in text:
+        return frozenset(['BV'])
+    return frozenset()
+
+_comparison = re.compile(r'\((?P<op>bvult|bvule|bvugt|bvuge|=) (?P<left>.+) (?P<right>[^ ()]+)\)$')
+#the same comparison with the operands swapped and negated
+_swapped = {'bvult': 'bvugt', 'bvule': 'bvuge', 'bvugt': 'bvult', 'bvuge': 'bvule', '=': '='}
+_negated = {'bvult': 'bvuge', 'bvule': 'bvugt', 'bvugt': 'bvule', 'bvuge': 'bvult'}
+
+#engine capabilities and the commands telling whether they are supported
+_probes = [('check-sat-assuming', ['(check-sat-assuming ((= probe!x #x00)))']),
+           ('simplify', ['(simplify (bvadd probe!x #x01))']),
+           ('get-model', ['(check-sat)', '(get-model)']),
+           ('optimization', ['(push 1)', '(minimize probe!x)', '(check-sat)', '(pop 1)']),
+           #last, it forgets the probe declarations
+           ('reset', ['(reset)'])]
+
+def _probe(config):
+    ''' Starts the engine of config and asks which _probes it supports and
+        its version. Every probe is followed by a get-info so commands that
+        answer nothing can be told apart from the ones that fail.
+    '''
+    capabilities = dict((name, False) for name, commands in _probes)
+    capabilities['version'] = None
+    backend = config['backend'](config)
+    backend.start()
+    try:
+        for cmd in config['init']:
+            backend.send(cmd)
+        backend.send('(set-logic QF_BV)')
+        backend.send('(declare-fun probe!x () (_ BitVec 8))')
+        backend.send('(declare-fun probe!b () Bool)')
+        for name, commands in _probes:
+            for cmd in commands:
+                backend.send(cmd)
+            backend.send('(get-info :version)')
+            supported = True
+            response = ''
+            while not response.startswith('(:version'):
+                response = backend.recv()
+                if not response:
+                    #the engine died, what is left is not supported
+                    return capabilities
+                if response.startswith('(error') or response == 'unsupported':
+                    supported = False
+            capabilities[name] = supported
+            version = re.search('"(.*)"', response)
+            capabilities['version'] = version.group(1) if version else None
+    finally:
+        backend.stop()
+    return capabilities
+
+def _exclusive(method):
+    ''' Holds the solver lock around method when the solver is threadsafe.
+        A query is several exchanges with the engine (a check and then a
+        get-value...), locking the pipe alone would not keep them together.
+    '''
+    @wraps(method)
+    def locked(self, *args, **kwargs):
+        if not self.threadsafe:
+            return method(self, *args, **kwargs)
+        with self._mutex:
+            return method(self, *args, **kwargs)
+    return locked
+
 class Solver(object):
 
     _config = {
         'z3': {
+            'backend': SubprocessBackend,
             'command': 'z3 -t:120 -smt2 -in',
             'init': ['(set-option :global-decls false)'],
-            'version': ('z3 -version', 'Z3 version 4.3.2'),
             'get-value-fmt': (re.compile('\(\((?P<expr>(.*))\ #x(?P<value>([0-9a-fA-F]*))\)\)'), 16),
+            'unsat-core': {'init': ['(set-option :produce-unsat-cores true)', '(set-option :global-decls false)']},
+            'support-simplify' : True,
+            'support-reset' : True,
+        },
+        #in-process z3: no pipe round-trip, commands are still parsed text
+        'z3api': {
+            'backend': Z3Backend,
+            'init': ['(set-option :timeout 120)'],
+            'get-value-fmt': (re.compile('\(\((?P<expr>(.*))\ #x(?P<value>([0-9a-fA-F]*))\)\)'), 16),
+            'unsat-core': {'params': {'unsat_core': True}},
             'support-simplify' : True,
             'support-reset' : True,
         },
         'cvc4': {
+            'backend': SubprocessBackend,
             'command': 'cvc4 --incremental --lang=smt2',
             # 'init': ['(set-logic QF_AUFBV)', '(set-option :produce-models true)', '(set-info :smt-lib-version 2.5)'],
-            'init': ['(set-logic QF_AUFBV)', '(set-option :produce-models true)'],
+            'init': ['(set-option :produce-models true)'],
+            'unsat-core': {'init': ['(set-option :produce-unsat-cores true)', '(set-option :produce-models true)']},
             'get-value-fmt': (re.compile('\(\((?P<expr>(.*))\ \(_\ bv(?P<value>(\d*))\ \d*\)\)\)'), 10),
             'support-simplify' : False,
             'support-reset' : False,
         },
         'yices' : {
+            'backend': SubprocessBackend,
             'command': 'yices-smt2 --incremental',
-            'init': ['(set-logic QF_AUFBV)'],
+            'init': [],
+            'unsat-core': {'init': ['(set-option :produce-unsat-cores true)']},
             'get-value-fmt' : (re.compile('\(\((?P<expr>(.*))\ #b(?P<value>([0-1]*))\)\)'), 2),
             'support-simplify' : False,
             'support-reset' : True,
         },
     }
 
-    def __init__(self, engine='z3'):
+    #subterms at least this long are sent once and then named (None disables)
+    share_min_size = 64
+    #when set operators build terms without simplifying them, a term is
+    #simplified once it is asserted or grows past lazy_simplify_size
+    lazy_simplify = False
+    lazy_simplify_size = 200
+    #simplify results kept per solver, the least recently used go first
+    simplify_cache_size = 1<<14
+    #replaying the state to a restarted engine is sent in chunks this big
+    replay_chunk_size = 1<<16
+    #probed engine capabilities are kept in this file between runs (None
+    #disables the probe and the config support- flags are used as they are)
+    capabilities_cache = os.path.join(os.path.expanduser('~'), '.cache', 'pysmtlib', 'capabilities')
+    #(engine, identity) -> capabilities probed in this process
+    _capabilities = {}
+    #engine name -> backend factory used instead of the engine default
+    backends = {}
+    #gets every command and response when set (see smtlib_trace.Recorder)
+    recorder = None
+    #when set queries and state changes hold a per solver lock, so threads
+    #may share a solver (the instance flag is not pickled)
+    threadsafe = False
+    #before a check the engine process is replaced, and the state replayed
+    #into the new one, once it crossed any of these: resident memory in
+    #bytes, responses read, seconds spent waiting for them (None disables)
+    recycle_rss = None
+    recycle_queries = None
+    recycle_time = None
+
+    def __init__(self, engine='z3', backend=None):
         ''' Build a solver intance.
             This is implemented using an external native solver via a subprocess.
             Everytime a new symbol or assertion is added a smtlibv2 command is 
@@ -520,43 +1470,144 @@ class Solver(object):
             restore the state. 
             The analisys may be saved to disk and continued after a while or 
             forked in memory or even sent over the network.
+            @param backend: builds the Backend from the engine config, the
+                            engine default if None. It is not pickled.
         '''
         self._engine = engine
+        self._backend_factory = backend
         self._status = 'unknown'
         self._sid = 0
         self._stack = []
         self._declarations = {} #weakref.WeakValueDictionary()
-        self._constraints = set()
+        self._constraints = _Constraints()
+        self._aux = {}
+        self._auxsymbols = weakref.WeakValueDictionary()
+        self._bounds = {}
+        self._needed = frozenset()
+        self._constants = weakref.WeakValueDictionary()
+        self._clear_simplified()
         self.input_symbols = list()
-        self._proc = None
+        self._backend = None
+        self._mutex = threading.RLock()
+        self.recycle_stats = {'rss': 0, 'queries': 0, 'time': 0}
         self._check_solver_version()
         self._start_proc()
 
     def _check_solver_version(self):
-        if 'version' in self._config[self._engine]:
-            command, banner = self._config[self._engine]['version']
-            # assert banner in check_output(command.split(' '))
+        self._supported = self.capabilities(self._engine)
+        self.version = self._supported.get('version')
+
+    @classmethod
+    def capabilities(cls, engine):
+        ''' The commands engine supports and its version, probed once per
+            engine build. The result is cached on disk keyed by the engine
+            binary path and its mtime. Empty if the engine can not be probed.
+        '''
+        config = cls._config[engine]
+        identity = config['backend'].identity(config)
+        if identity is None or cls.capabilities_cache is None:
+            return {}
+        #new probes are run again on an engine probed before
+        key = (engine, identity, tuple(name for name, commands in _probes))
+        if key not in cls._capabilities:
+            try:
+                with open(cls.capabilities_cache, 'rb') as f:
+                    cache = pickle.load(f)
+            except Exception:
+                cache = {}
+            if key not in cache:
+                cache[key] = _probe(config)
+                try:
+                    directory = os.path.dirname(cls.capabilities_cache)
+                    if not os.path.isdir(directory):
+                        os.makedirs(directory)
+                    #other processes may be reading it, replace it at once
+                    tmp = '%s.%d'%(cls.capabilities_cache, os.getpid())
+                    with open(tmp, 'wb') as f:
+                        pickle.dump(cache, f, 2)
+                    os.rename(tmp, cls.capabilities_cache)
+                except (IOError, OSError), e:
+                    logger.warning('Can not cache engine capabilities: %s', e)
+            cls._capabilities[key] = cache[key]
+        return cls._capabilities[key]
+
+    def _supports(self, command):
+        ''' True if the engine supports command, as probed or configured '''
+        default = self._config[self._engine].get('support-%s'%command, False)
+        return self._supported.get(command, default)
 
     def _start_proc(self):
-        self._proc = Popen(self._config[self._engine]['command'], shell=True, stdin=PIPE, stdout=PIPE)        #'stp --SMTLIB2'
+        config = self._config[self._engine]
+        factory = self._backend_factory or self.backends.get(self._engine, config['backend'])
+        self._backend = factory(config)
+        self._backend.start()
+        self.engine_stats = {'queries': 0, 'time': 0.0}
+        self._sent = time.time()
+        self._shared = None
+        if self.share_min_size is not None:
+            self._shared = SharedTerms(self.share_min_size)
+        self._init_engine()
+
+    def _init_engine(self):
+        if self.recorder is not None:
+            self.recorder.started(self)
         #run solver specific initializations
         for cfg in self._config[self._engine]['init']:
             self._send(cfg)
+        self._logic = self._pick_logic()
+        self._send('(set-logic %s)'%self._logic)
 
+    def _pick_logic(self):
+        ''' The narrowest logic covering the declarations and constraints.
+            A new solver gets QF_BV as nearly every state declares bitvectors.
+        '''
+        if not self._declarations and not self._constraints and not self._needed:
+            return 'QF_BV'
+        theories = set(self._needed)
+        for var in self._declarations.itervalues():
+            theories |= _theories(var.declaration)
+        for c in self._constraints:
+            theories |= _theories(c.value)
+        for logic, covered in _logics:
+            if theories <= covered:
+                return logic
+
+    def _widen(self, text):
+        ''' Restarts the engine with a wider logic if text (part of the
+            state or about to be queried) needs it. Returns True if it did.
+        '''
+        theories = _theories(text)
+        if theories <= dict(_logics)[self._logic]:
+            return False
+        #queries are not part of the state, remember what they needed
+        self._needed |= theories
+        self._restart()
+        return True
+
+
+    def _clear_simplified(self):
+        ''' Empties the simplify cache. Every push level lists the keys
+            cached in it, they may name symbols a pop takes away.
+        '''
+        self._simplified = collections.OrderedDict()
+        self._simplified_levels = [[] for frame in self._stack]
+        self.simplify_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
 
     def _stop_proc(self):
-        #self._send('(quit)')
-        self._proc.kill()
-        self._proc.wait()
-        self._proc = None
+        self._backend.stop()
+        self._backend = None
 
     #marshaling/pickle
     def __getstate__(self):
+        self.collect()
         state = {}
         state['engine'] = self._engine
         state['sid'] = self._sid
         state['declarations'] = self._declarations
         state['constraints'] = self._constraints
+        state['aux'] = self._aux
+        state['auxsymbols'] = dict(self._auxsymbols)
+        state['bounds'] = self._bounds
         state['stack'] = self._stack
         state['input_symbols'] = self.input_symbols
         state['status'] = self._status
@@ -564,24 +1615,106 @@ class Solver(object):
 
     def __setstate__(self, state):
         self._engine = state['engine']
+        self._backend_factory = state.get('backend', None)
         # self._status = None
         self._status = state['status']
         self._sid = state['sid']
         self._declarations = state['declarations'] #weakref.WeakValueDictionary(state['declarations'])
         self._constraints = state['constraints']
+        self._aux = state['aux']
+        self._auxsymbols = weakref.WeakValueDictionary(state['auxsymbols'])
+        self._bounds = state['bounds']
+        self._needed = frozenset()
+        self._constants = weakref.WeakValueDictionary()
         self._stack = state['stack']
+        self._clear_simplified()
         self.input_symbols = state['input_symbols']
+        self._mutex = threading.RLock()
+        self.recycle_stats = {'rss': 0, 'queries': 0, 'time': 0}
+        self._check_solver_version()
         self._start_proc()
+        self._replay()
+
+    def _alive(self):
+        return self._backend is not None and self._backend.alive()
 
+    @_exclusive
     def reset(self):
-        if self._config[self._engine]['support-reset']:
+        ''' Makes sure the engine holds the current state. Nothing is done
+            unless the engine died or reported an error, in which case it is
+            restarted and the state (push frames included) is replayed.
+        '''
+        if self._status is not None and self._alive():
+            return
+        self._restart()
+
+    def _restart(self, fresh=False):
+        ''' Restarts the engine and replays the state into it
+            @param fresh: start a new engine process even if it can reset
+        '''
+        self.collect()
+        if not fresh and self._supports('reset') and self._alive():
             self._send("(reset)")
-        else: 
-            self._stop_proc()
+            if self._shared is not None:
+                self._shared.clear()
+            self._init_engine()
+        else:
+            if self._backend is not None:
+                self._stop_proc()
             self._start_proc()
-        self._send(self)
+        self._replay()
         self._status = 'unknown'
 
+    def _recycle(self):
+        ''' Replaces the engine process if it crossed a recycle_ threshold.
+            Only called right before a check, when no model or response
+            the caller still needs is held by the engine.
+        '''
+        stats = self.engine_stats
+        if self.recycle_queries is not None and stats['queries'] >= self.recycle_queries:
+            reason = 'queries'
+        elif self.recycle_time is not None and stats['time'] >= self.recycle_time:
+            reason = 'time'
+        elif self.recycle_rss is not None and (self._backend.rss() or 0) >= self.recycle_rss:
+            reason = 'rss'
+        else:
+            return
+        logger.info('recycling the %s engine after %d queries, %.2fs (%s)',
+                    self._engine, stats['queries'], stats['time'], reason)
+        self.recycle_stats[reason] += 1
+        self._restart(fresh=True)
+
+    def _replay(self):
+        ''' Streams the state into the engine in chunks of about
+            replay_chunk_size bytes. Every saved push frame is rebuilt in
+            order so pops keep matching the engine assertion stack.
+        '''
+        frames = [(d, c) for _, d, c, _, _ in self._stack]
+        frames.append((self._declarations, self._constraints))
+        chunk = []
+        size = 0
+        last_declarations, last_constraints = {}, set()
+        for i, (declarations, constraints) in enumerate(frames):
+            if i > 0:
+                if chunk:
+                    self._send('\n'.join(chunk))
+                    chunk, size = [], 0
+                self._send('(push 1)')
+                if self._shared is not None:
+                    self._shared.push()
+            commands = [var.declaration for name, var in declarations.iteritems()
+                                        if last_declarations.get(name) is not var]
+            commands += ['(assert %s)'%c for c in constraints if c not in last_constraints]
+            for command in commands:
+                chunk.append(command)
+                size += len(command)
+                if size >= self.replay_chunk_size:
+                    self._send('\n'.join(chunk))
+                    chunk, size = [], 0
+            last_declarations, last_constraints = declarations, constraints
+        if chunk:
+            self._send('\n'.join(chunk))
+
     def __del__(self):
         self._stop_proc()
 
@@ -594,44 +1727,67 @@ class Solver(object):
         ''' Send a string to the solver.
             @param cmd: a SMTLIBv2 command (ex. (check-sat))
         '''
+        cmd = str(cmd)
+        if self._shared is not None and len(cmd) > self._shared.min_size:
+            cmd = self._shared.rewrite(cmd, self._sortof)
         logger.debug('>%s',cmd)
-        self._proc.stdin.writelines((str(cmd),'\n'))
+        if self.recorder is not None:
+            self.recorder.sent(self, cmd)
+        self._sent = time.time()
+        self._backend.send(cmd)
+
+    def _sortof(self, name):
+        ''' The sort of a declared symbol as understood by SharedTerms '''
+        var = self._declarations.get(name)
+        if isinstance(var, BitVec):
+            return var.size
+        if isinstance(var, Bool):
+            return 'Bool'
+        if isinstance(var, Array):
+            return ('Array', var.array.size, 8)
+        return None
 
     def _recv(self):
         ''' Reads the response from the solver '''
-        def readline():
-            buf = self._proc.stdout.readline()
-            return buf, buf.count('('), buf.count(')')
-        bufl = []
-        left = 0
-        right = 0
-        buf,l,r = readline()
-        bufl.append(buf)
-        left +=l
-        right+=r
-        while left != right:
-            buf,l,r = readline()
-            bufl.append(buf)
-            left +=l
-            right+=r
-        buf = ''.join(bufl).strip()
+        buf = self._backend.recv()
+        #the engine works from the last command sent to its response
+        self.engine_stats['queries'] += 1
+        self.engine_stats['time'] += time.time() - self._sent
         logger.debug('<%s', buf)
-        if '(error' in bufl[0]:
+        if self.recorder is not None:
+            self.recorder.received(self, buf)
+        if not buf and not self._alive():
+            self._status = None
+            raise Exception("Solver engine died")
+        if buf.startswith('(error'):
+            #whatever the engine holds now is not to be trusted
+            self._status = None
             print "Error in simplify", buf
             raise Exception("Error in smtlib <"+str(self)+">")
         return buf
 
+    @_exclusive
+    def dump(self, f):
+        ''' Writes a smtlib representation of the current state to the file
+            like f one piece at a time, the whole text is never built.
+        '''
+        for d in self._declarations.itervalues():
+            f.write(d.declaration)
+            f.write('\n')
+        for c in self._constraints:
+            f.write('(assert ')
+            f.write(c.value)
+            f.write(')\n')
+
     def __str__(self):
         ''' Returns a smtlib representation of the current state '''
-        buf = ''
-        for d in self._declarations.values():
-            buf += d.declaration +'\n'
-        for a in self.constraints:
-            buf += '%s\n'%a
-        return buf
+        buf = StringIO()
+        self.dump(buf)
+        return buf.getvalue()
 
 
     #get-all-values min max minmax
+    @_exclusive
     def getallvalues(self, x, maxcnt = 30):
         ''' Returns a list with all the possible values for the symbol x'''
         assert self.check() == 'sat'
@@ -639,8 +1795,7 @@ class Solver(object):
         result = []
         self.push()
         try:
-            aux = self.mkBitVec(x.size)
-            self.add(aux==x)
+            aux = self._mkaux(x)
             r = self.check()
             val = None
             while r != 'unsat':
@@ -656,6 +1811,7 @@ class Solver(object):
             self.pop()
         return result
 
+    @_exclusive
     def max(self, X, M=10000):
         ''' Iterativelly finds the maximum value for a symbol.
             @param X: a symbol or expression
@@ -663,10 +1819,15 @@ class Solver(object):
         '''
         assert self.check() == 'sat'
         assert type(X) is BitVec
+        lo, hi = X.bounds
+        if lo == hi:
+            return lo
         self.push()
-        aux = self.mkBitVec(X.size)
-        self.add(aux==X)
+        aux = self._mkaux(X)
         try:
+            value = self._optimize('maximize', aux)
+            if value is not None:
+                return value
             last_value = None
             i = 0
             while True:
@@ -678,6 +1839,8 @@ class Solver(object):
                         raise Exception("max failed")
                 elif r == 'sat': 
                     last_value = self.getvalue(aux)
+                    if last_value == hi:
+                        return last_value
                     self.add(UGT(aux,last_value))
                     i = i + 1
                 else:
@@ -687,6 +1850,7 @@ class Solver(object):
         finally:
             self.pop()
 
+    @_exclusive
     def min(self, X, M=10000):
         ''' Iterativelly finds the minimum value for a symbol.
             @param X: a symbol or expression
@@ -694,10 +1858,15 @@ class Solver(object):
         '''
         assert self.check() == 'sat'
         assert type(X) is BitVec
+        lo, hi = X.bounds
+        if lo == hi:
+            return lo
         self.push()
-        aux = self.mkBitVec(X.size)
-        self.add(aux==X)
+        aux = self._mkaux(X)
         try:
+            value = self._optimize('minimize', aux)
+            if value is not None:
+                return value
             last_value = None
             i = 0
             while True:
@@ -709,6 +1878,8 @@ class Solver(object):
                         raise Exception("max failed")
                 elif r == 'sat': 
                     last_value = self.getvalue(aux)
+                    if last_value == lo:
+                        return last_value
                     self.add(ULT(aux,last_value))
                     i = i + 1
                 else:
@@ -718,6 +1889,26 @@ class Solver(object):
         finally:
             self.pop()
 
+    def _optimize(self, goal, x):
+        ''' Lets the engine find the optimum of x on its own when it supports
+            optimization, in a single query. None if it does not or can not
+            tell within its timeout.
+            @param goal: 'maximize' or 'minimize'
+        '''
+        if not self._supports('optimization'):
+            return None
+        self.push()
+        try:
+            self._send('(%s %s)'%(goal, x))
+            self._send('(check-sat)')
+            if self._recv() != 'sat':
+                return None
+            self._status = 'sat'
+            return self.getvalue(x)
+        finally:
+            self.pop()
+
+    @_exclusive
     def minmax(self, x, iters=10000):
         ''' Returns the min and max possible values for x. '''
         if isconcrete(x):
@@ -727,31 +1918,137 @@ class Solver(object):
         return m, M
 
     # push pop
+    @_exclusive
     def push(self):
         ''' Pushes and save the current state.'''
         if self._status is None:
             self.reset()
         self._send('(push 1)')
-        self._stack.append((self._sid, self._declarations, self._constraints))
+        if self._shared is not None:
+            self._shared.push()
+        self._stack.append((self._sid, self._declarations, self._constraints, self._aux, self._bounds))
+        self._simplified_levels.append([])
         self._declarations = copy.copy(self._declarations)
         self._constraints = copy.copy(self._constraints)
+        self._aux = copy.copy(self._aux)
+        self._bounds = copy.copy(self._bounds)
 
+    @_exclusive
     def pop(self):
         ''' Recall the last pushed state. '''
         self._send('(pop 1)')
-        self._sid, self._declarations, self._constraints = self._stack.pop()
+        if self._shared is not None:
+            self._shared.pop()
+        self._sid, self._declarations, self._constraints, self._aux, self._bounds = self._stack.pop()
+        #names are handed out again after a pop
+        for key in self._simplified_levels.pop():
+            self._simplified.pop(key, None)
         self._status = 'unknown'
 
     ## UTILS: check-sat get-value simplify 
+    @_exclusive
     def check(self):
         ''' Check the satisfiability of the current state '''
         if self._status is None:
             self.reset()
         if self._status == 'unknown':
+            self._recycle()
             self._send('(check-sat)')
             self._status = self._recv()
         return self._status
 
+    @_exclusive
+    def can_be_true(self, cond):
+        ''' True if cond holds in some model of the current state. The state
+            is left as it is: engines supporting check-sat-assuming take cond
+            as an assumption, the others get it between a push and a pop.
+            @param cond: a Bool or a python bool
+        '''
+        if isinstance(cond, bool):
+            return cond and self.check() == 'sat'
+        return self._assume(cond) is not None
+
+    def _assume(self, cond, terms=()):
+        ''' Checks the state assuming cond. None if that is unsat, otherwise
+            the values of the Bool terms in the model found.
+        '''
+        if self._status is None:
+            self.reset()
+        if self._status == 'unsat':
+            return None
+        values = None
+        if not self._supports('check-sat-assuming'):
+            self.push()
+            try:
+                self.add(cond)
+                status = self.check()
+                if status == 'sat':
+                    values = self._getvalues(terms)
+            finally:
+                self.pop()
+        else:
+            self._recycle()
+            self._widen(cond.value)
+            self._send('(check-sat-assuming (%s))'%cond)
+            status = self._recv()
+            #a model of the state and cond is a model of the state, other
+            #answers leave no model behind
+            if status == 'sat':
+                self._status = 'sat'
+                values = self._getvalues(terms)
+            elif self._status == 'sat':
+                self._status = 'unknown'
+        if status not in ('sat', 'unsat'):
+            raise Exception("solver failed %s"%status)
+        return values
+
+    def _getvalues(self, terms):
+        ''' The values of the Bool terms in the last model, one get-value '''
+        if not terms:
+            return []
+        self._send('(get-value (%s))'%' '.join(map(str, terms)))
+        ret = self._recv()
+        assert ret.startswith('((') and ret.endswith('))')
+        return [pair[1:-1].rsplit(' ', 1)[1] == 'true' for pair in _arguments(ret[1:-1])]
+
+    @_exclusive
+    def feasible(self, conds):
+        ''' For each of conds, True if it holds in some model of the current
+            state. Every model found decides all the conditions true in it,
+            the engine is only asked again for a model of the undecided ones.
+            @param conds: a list of Bools or python bools
+        '''
+        result = [False] * len(conds)
+        if any(cond is True for cond in conds) and self.check() == 'sat':
+            result = [cond is True for cond in conds]
+        undecided = collections.OrderedDict()
+        for i, cond in enumerate(conds):
+            if isinstance(cond, Bool):
+                undecided.setdefault(cond.value, (cond, []))[1].append(i)
+        while undecided:
+            terms = [cond for cond, indices in undecided.values()]
+            if len(terms) == 1:
+                any_of = terms[0]
+            else:
+                any_of = Bool('or', *terms, solver=self)
+            values = self._assume(any_of, terms)
+            if values is None:
+                break
+            assert True in values
+            for text, value in zip(undecided.keys(), values):
+                if value:
+                    for i in undecided.pop(text)[1]:
+                        result[i] = True
+        return result
+
+    @_exclusive
+    def must_be_true(self, cond):
+        ''' True if cond holds in every model of the current state '''
+        if isinstance(cond, bool):
+            return cond or self.check() == 'unsat'
+        return not self.can_be_true(~cond)
+
+    @_exclusive
     def getvalue(self, val):
         ''' Ask the solver for one possible assigment for val using currrent set
             of constraints.
@@ -766,7 +2063,13 @@ class Solver(object):
         '''
         if isconcrete(val):
             return val
+        self._widen(str(val))
         assert self.check() == 'sat'
+        if isinstance(val, BitVec):
+            #pinned by the constraints, any model has it
+            lo, hi = val.bounds
+            if lo == hi:
+                return lo
         self._send('(get-value (%s))'%val)
         ret = self._recv()
         assert ret.startswith('((') and ret.endswith('))')
@@ -776,6 +2079,7 @@ class Solver(object):
         assert(expr == str(val))
         return int(value, base)
 
+    @_exclusive
     def simplify(self, val):
         ''' Ask the solver to try to simplify the expression val.
             This works only with z3.
@@ -786,23 +2090,132 @@ class Solver(object):
         #file('simplifications.txt','a').write('(simplify %s  :expand-select-store true :pull-cheap-ite true )'%val+'\n')
         if not isinstance(val, (BitVec, Bool)):
             return val
-        if not self._config[self._engine]['support-simplify']:
+        if not self._supports('simplify'):
             return val
-        self._send('(simplify %s  :expand-select-store true :pull-cheap-ite true )'%val)
-        result = self._recv()
-        #TODO fix this HACK!
-        if "bvsmod_i" in result:
+        result = self._simplify(val)
+        if result is None:
             return val
 
         #TODO clean move casts somewhere else.  BitVec8, BitVec16, BitVec32, BitVec64, BitVec127 __new__() ?
         if type(val) is BitVec:
             if result.startswith('#x'):
                 return int(result[2:],16)
-            return BitVec(val.size, result, solver=val.solver)
+            bv = BitVec(val.size, result, solver=val.solver, aux=_auxdeps((val,)))
+            bv._setfacts(*_facts(val))
+            return bv
         elif type(val) is Bool:
-            return {'false':False, 'true':True}.get(result, Bool(result,solver=val.solver))
+            return {'false':False, 'true':True}.get(result, Bool(result,solver=val.solver, aux=_auxdeps((val,))))
+
+    def _simplify(self, val):
+        ''' The simplified text of val, None if it is better left as is.
+            Cached by text, the engine is only asked on a miss.
+        '''
+        key = (getattr(val, 'size', None), val.value)
+        result = self._simplified.pop(key, False)
+        if result is not False:
+            self.simplify_stats['hits'] += 1
+            self._simplified[key] = result
+            return result
+        self.simplify_stats['misses'] += 1
+        self._widen(val.value)
+        self._send('(simplify %s  :expand-select-store true :pull-cheap-ite true )'%val)
+        result = self._recv()
+        #z3 may answer with its internal division functions (bvudiv_i...)
+        if _internal.search(result):
+            result = None
+        if self.simplify_cache_size:
+            while len(self._simplified) >= self.simplify_cache_size:
+                self._simplified.popitem(last=False)
+                self.simplify_stats['evictions'] += 1
+            self._simplified[key] = result
+            if self._simplified_levels:
+                keys = self._simplified_levels[-1]
+                keys.append(key)
+                #forget the evicted ones now and then
+                if len(keys) > 2*self.simplify_cache_size:
+                    keys[:] = [k for k in keys if k in self._simplified]
+        return result
+
+    @_exclusive
+    def unsat_core(self, minimize=False):
+        ''' Returns the constraints (out of self._constraints) that are
+            already unsat on their own, or None if the state is not unsat or
+            the scratch engine does not find it unsat (a constant False was
+            added, or it answers unknown).
+            The query runs on a scratch engine where every constraint is
+            guarded by a named literal so the live engine is not touched.
+            @param minimize: drop constraints one by one while the rest stays
+                             unsat so no constraint of the core is redundant
+        '''
+        if self.check() != 'unsat':
+            return None
+        constraints = list(self._constraints)
+        config = dict(self._config[self._engine])
+        config.update(config['unsat-core'])
+        backend = config['backend'](config)
+        backend.start()
+        recorder = self.recorder
+
+        def send(cmd):
+            if recorder is not None:
+                recorder.sent(backend, cmd)
+            backend.send(cmd)
+
+        def recv():
+            buf = backend.recv()
+            if recorder is not None:
+                recorder.received(backend, buf)
+            return buf
+
+        try:
+            if recorder is not None:
+                recorder.started(backend, '%s unsat-core'%self._engine)
+            for cmd in config['init']:
+                send(cmd)
+            send('(set-logic %s)'%self._logic)
+            for var in self._declarations.values():
+                send(var.declaration)
+            for i, c in enumerate(constraints):
+                send('(declare-fun core!%d () Bool)'%i)
+                send('(assert (=> core!%d %s))'%(i, c))
+
+            def core(indexes):
+                send('(check-sat-assuming (%s))'%' '.join('core!%d'%i for i in indexes))
+                status = recv()
+                if status != 'unsat':
+                    return None
+                send('(get-unsat-core)')
+                names = set(int(n) for n in re.findall('core!(\d+)', recv()))
+                return [i for i in indexes if i in names]
+
+            indexes = core(range(len(constraints)))
+            if indexes is None:
+                return None
+            if minimize:
+                i = 0
+                while i < len(indexes):
+                    smaller = core(indexes[:i] + indexes[i+1:])
+                    if smaller is None:
+                        i += 1
+                    else:
+                        indexes = smaller
+        finally:
+            backend.stop()
+        return [constraints[i] for i in indexes]
+
+    def contains_core(self, core):
+        ''' True if every constraint of an unsat core (maybe taken from
+            another solver state) is part of this state, which is then
+            unsat without asking the engine. An empty or None core never
+            matches.
+        '''
+        if not core:
+            return False
+        constraints = set(str(c) for c in self._constraints)
+        return all(str(c) in constraints for c in core)
 
     ## declarations
+    @_exclusive
     def mkBitVec(self, size, name = 'V', is_input=False):
         ''' Creates a symbol in the constrains store and names it name'''
         assert size in [1,8,16,32,64,128,256]
@@ -810,11 +2223,61 @@ class Solver(object):
             name = '%s_%d'%(name, self._get_sid())
         bv = BitVec(size, name, solver=self)
         self._declarations[name] = bv
-        self._send(bv.declaration)
+        if not self._widen(bv.declaration):
+            self._send(bv.declaration)
         if is_input:
             self.input_symbols.append((bv,))
         return bv
 
+    @_exclusive
+    def _mkaux(self, expr):
+        ''' Returns a new auxiliary symbol constrained to be equal to expr.
+            The symbol and its defining constraint are dropped from the state
+            by collect() once nothing references the symbol anymore.
+        '''
+        name = self.mkBitVec(expr.size).value
+        definition = self._declarations[name] == expr
+        self.add(definition)
+        aux = BitVec(expr.size, name, solver=self)
+        aux._isaux = True
+        aux._setfacts(*_facts(expr))
+        self._aux[name] = definition
+        self._auxsymbols[name] = aux
+        return aux
+
+    @_exclusive
+    def collect(self):
+        ''' Drops the auxiliary symbols (and their defining constraints) that
+            are no longer referenced by any live expression or constraint.
+            Only the replayable state shrinks; the engine keeps whatever it
+            was already told.
+            Returns a dict with the number of declarations, constraints and
+            bytes of smtlib reclaimed.
+        '''
+        frames = [(d, c, a) for _, d, c, a, _ in self._stack]
+        frames.append((self._declarations, self._constraints, self._aux))
+        report = {'declarations': 0, 'constraints': 0, 'bytes': 0}
+        reclaimed = set()
+        #dropping a definition may release the auxiliary symbols it refers to
+        collected = True
+        while collected:
+            collected = False
+            for declarations, constraints, aux in frames:
+                for name in [n for n in aux if n not in self._auxsymbols]:
+                    definition = aux.pop(name)
+                    declaration = declarations.pop(name)
+                    constraints.discard(definition)
+                    collected = True
+                    if name not in reclaimed:
+                        reclaimed.add(name)
+                        report['declarations'] += 1
+                        report['constraints'] += 1
+                        report['bytes'] += len(declaration.declaration) + len('(assert %s)'%definition)
+        if report['declarations']:
+            logger.info('Reclaimed %(declarations)d declarations, %(constraints)d constraints, %(bytes)d bytes', report)
+        return report
+
+    @_exclusive
     def mkArray(self, size=32, name='A', is_input=False, max_size=100):
         ''' Creates a symbols array in the constrains store and names it name'''
         assert size in [8,16,32,64]
@@ -823,11 +2286,13 @@ class Solver(object):
             name = '%s_%d'%(name, self._get_sid())
         arr = Array(size, name, solver=self)
         self._declarations[name] = arr #.array
-        self._send(arr.declaration)
+        if not self._widen(arr.declaration):
+            self._send(arr.declaration)
         if is_input:
             self.input_symbols.append((arr, max_size))
         return arr
 
+    @_exclusive
     def mkBool(self, name='B', is_input=False):
         ''' Creates a symbols array in the constrains store and names it name'''
         if name in self._declarations:
@@ -848,17 +2313,79 @@ class Solver(object):
         return declarations
 
     #assertions
+    @_exclusive
     def add(self, constraint):
+        ''' Asserts constraint. A top level conjunction is asserted one
+            conjunct at a time, constants and assertions already in the state
+            are not sent, and a constraint that contradicts the state in an
+            obvious way (it is the negation of an assertion, or it empties
+            the interval of an expression) makes it unsat without the engine.
+        '''
         if isinstance(constraint, bool):
             if not constraint:
                 self._status = 'unsat'
             return
         assert isinstance(constraint, Bool)
-        self._send('(assert %s)'%constraint)
+        if self.lazy_simplify:
+            #all the operations pending on it in a single engine exchange
+            constraint = self.simplify(constraint)
+            if isinstance(constraint, bool):
+                return self.add(constraint)
+        text = constraint.value
+        if text in ('true', 'false'):
+            return self.add(text == 'true')
+        if text.startswith('(and '):
+            for conjunct in _arguments(text[5:-1]):
+                self.add(Bool(conjunct, solver=self, aux=constraint._aux))
+            return
+        if self._constraints.hastext(text):
+            return
+        if text.startswith('(not ') and self._constraints.hastext(text[5:-1]) or \
+           self._constraints.hastext('(not %s)'%text):
+            self._status = 'unsat'
         self._constraints.add(constraint)
-        self._status = 'unknown'
+        if not self._widen(constraint.value):
+            self._send('(assert %s)'%constraint)
+        #a broken engine stays marked so the next query replays the state
+        if self._status not in (None, 'unsat'):
+            self._status = 'unknown'
+        if not self._refine(constraint.value):
+            self._status = 'unsat'
         #assert self.check() != 'unsat', "Impossible constraint asserted"
 
+    def _refine(self, constraint):
+        ''' Narrows the interval of an expression compared against a constant
+            by constraint. Returns False if the interval becomes empty.
+        '''
+        negated = constraint.startswith('(not (') and constraint.endswith('))')
+        if negated:
+            constraint = constraint[5:-1]
+        m = _comparison.match(constraint)
+        if m is None:
+            return True
+        op, left, right = m.group('op'), m.group('left'), m.group('right')
+        if _constant(right) is None:
+            left, right, op = right, left, _swapped[op]
+        value = _constant(right)
+        if negated:
+            op = _negated.get(op)
+        if value is None or op is None:
+            return True
+        size = len(right)-2 if right.startswith('#b') else 4*(len(right)-2)
+        lo, hi = self._bounds.get(left, (0, (1<<size)-1))
+        if op == '=':
+            lo, hi = max(lo, value), min(hi, value)
+        elif op == 'bvult':
+            hi = min(hi, value-1)
+        elif op == 'bvule':
+            hi = min(hi, value)
+        elif op == 'bvugt':
+            lo = max(lo, value+1)
+        elif op == 'bvuge':
+            lo = max(lo, value)
+        self._bounds[left] = (lo, hi)
+        return lo <= hi
+
     @property
     def constraints(self):
         constraints = []
@@ -866,6 +2393,558 @@ class Solver(object):
             constraints.append('(assert %s)'%c)
         return constraints
 
+#scheduling many solvers on a few engines
+def _arguments(text):
+    ''' Splits the arguments of an application: atoms and whole terms '''
+    args = []
+    depth = 0
+    start = 0
+    for m in _token.finditer(text):
+        tok = m.group()
+        if tok == '(':
+            if depth == 0:
+                start = m.start()
+            depth += 1
+        elif tok == ')':
+            depth -= 1
+            if depth == 0:
+                args.append(text[start:m.end()])
+        elif depth == 0:
+            args.append(tok)
+    return args
+
+def _split_commands(text):
+    ''' Splits a string holding several SMTLIBv2 commands '''
+    commands = []
+    depth = 0
+    start = 0
+    for m in _token.finditer(text):
+        tok = m.group()
+        if tok == '(':
+            if depth == 0:
+                start = m.start()
+            depth += 1
+        elif tok == ')':
+            depth -= 1
+            if depth == 0:
+                commands.append(text[start:m.end()])
+    return commands
+
+class _Frame(object):
+    ''' A node of the scheduler trie: one state command after its parent '''
+    __slots__ = ('parent', 'command', 'depth', '__weakref__')
+
+    def __init__(self, parent, command):
+        self.parent = parent
+        self.command = command
+        self.depth = 0 if parent is None else parent.depth + 1
+
+def _common(a, b):
+    ''' Length of the common prefix of two trie paths given their tips '''
+    if a is None or b is None:
+        return 0
+    while a.depth > b.depth:
+        a = a.parent
+    while b.depth > a.depth:
+        b = b.parent
+    while a is not b:
+        a, b = a.parent, b.parent
+        if a is None:
+            return 0
+    return a.depth + 1
+
+class _Engine(object):
+    ''' An engine process and the trie path currently loaded in it.
+        Each element of levels is the index in path where an engine
+        assertion level (push) starts.
+    '''
+    def __init__(self, config):
+        self.config = config
+        self.backend = None
+        self.path = []
+        self.levels = []
+
+    def start(self):
+        self.backend = self.config['backend'](self.config)
+        self.backend.start()
+        for cfg in self.config['init']:
+            self.backend.send(cfg)
+        #shared by many states, any of them may use arrays
+        self.backend.send('(set-logic QF_AUFBV)')
+        self.path = []
+        self.levels = []
+
+    def stop(self):
+        if self.backend is not None:
+            self.backend.stop()
+            self.backend = None
+
+    def alive(self):
+        return self.backend is not None and self.backend.alive()
+
+class ScheduledBackend(Backend):
+    ''' The backend of a Solver created by a Scheduler.
+        State commands (declarations and assertions) are only recorded as a
+        path in the scheduler trie, push and pop just move along it. Queries
+        get the path loaded on one of the scheduler engines first.
+    '''
+    _state = ('(declare-', '(define-', '(assert', '(minimize', '(maximize')
+    _ignored = ('(set-option', '(set-logic', '(set-info')
+
+    def __init__(self, scheduler, config):
+        super(ScheduledBackend, self).__init__(config)
+        self._scheduler = scheduler
+        self._path = None
+        #the engine reserved from a query until its response is read
+        self._engine = None
+
+    def start(self):
+        self._path = []
+        self._marks = []
+
+    def stop(self):
+        self._path = None
+        if self._engine is not None:
+            self._scheduler._release(self._engine)
+            self._engine = None
+
+    def alive(self):
+        return self._path is not None
+
+    def send(self, cmd):
+        for command in _split_commands(cmd):
+            if command.startswith(self._state):
+                self._path.append(self._scheduler._frame(self._path[-1] if self._path else None, command))
+            elif command.startswith('(push'):
+                self._marks.append(len(self._path))
+            elif command.startswith('(pop'):
+                del self._path[self._marks.pop():]
+            elif command.startswith('(reset'):
+                self._path = []
+                self._marks = []
+            elif not command.startswith(self._ignored):
+                self._engine = self._scheduler._load(self._path, self._engine)
+                try:
+                    self._engine.backend.send(command)
+                except:
+                    self._engine.stop()
+                    self._scheduler._release(self._engine)
+                    self._engine = None
+                    raise
+
+    def recv(self):
+        engine, self._engine = self._engine, None
+        if engine is None:
+            raise Exception("No query waiting for a response")
+        try:
+            response = engine.backend.recv()
+            if response.startswith('(error'):
+                #the engine may not hold what we think it holds, restart it
+                engine.stop()
+        finally:
+            self._scheduler._release(engine)
+        return response
+
+class Scheduler(object):
+    ''' Runs many solvers on a handful of engine processes.
+        The states of all the solvers it creates are kept in a trie of
+        commands so sibling states share their common prefix. When a solver
+        asks something the scheduler picks the engine that is cheapest to
+        switch, pops it to the common ancestor and pushes only the differing
+        suffix. The engine then belongs to that solver until it reads the
+        response, so solvers may run on different threads.
+    '''
+    def __init__(self, engine='z3', processes=2):
+        self._engine = engine
+        self._frames = weakref.WeakValueDictionary()
+        self._engines = [_Engine(Solver._config[engine]) for i in range(processes)]
+        self._free = set(self._engines)
+        self._lock = threading.Condition()
+        self.stats = {'queries': 0, 'switches': 0, 'pops': 0, 'pushes': 0, 'commands': 0}
+
+    def solver(self):
+        ''' Returns a new empty Solver running on the scheduler engines '''
+        return Solver(self._engine, backend=self._backend)
+
+    def _backend(self, config):
+        return ScheduledBackend(self, config)
+
+    def close(self):
+        for engine in self._engines:
+            engine.stop()
+
+    def _frame(self, parent, command):
+        key = (id(parent), command)
+        with self._lock:
+            frame = self._frames.get(key)
+            if frame is None or frame.parent is not parent:
+                frame = _Frame(parent, command)
+                self._frames[key] = frame
+            return frame
+
+    def _cost(self, engine, path):
+        if not engine.alive():
+            return len(path)
+        common = _common(engine.path[-1] if engine.path else None, path[-1] if path else None)
+        return len(engine.path) - common + len(path) - common
+
+    def _release(self, engine):
+        with self._lock:
+            self._free.add(engine)
+            self._lock.notify()
+
+    def _load(self, path, engine=None):
+        ''' Returns an engine holding exactly path, reserved until given
+            back with _release.
+            @param engine: an engine already reserved by the caller
+        '''
+        with self._lock:
+            self.stats['queries'] += 1
+            if engine is None:
+                while not self._free:
+                    self._lock.wait()
+                free = [e for e in self._engines if e in self._free]
+                engine = min(free, key=lambda e: self._cost(e, path))
+                self._free.discard(engine)
+        if engine.alive() and self._cost(engine, path) == 0:
+            return engine
+
+        #the engine is ours, talk to it without holding the lock
+        try:
+            stats = self._switch(engine, path)
+        except:
+            engine.stop()
+            self._release(engine)
+            raise
+        with self._lock:
+            for name, count in stats.iteritems():
+                self.stats[name] += count
+        return engine
+
+    def _switch(self, engine, path):
+        ''' Pops engine to the common ancestor and pushes the rest of path '''
+        stats = {'switches': 1, 'pops': 0, 'pushes': 0, 'commands': 0}
+        if not engine.alive():
+            engine.stop()
+            engine.start()
+        tip = path[-1] if path else None
+        common = _common(engine.path[-1] if engine.path else None, tip)
+        while len(engine.path) > common:
+            start = engine.levels.pop()
+            engine.backend.send('(pop 1)')
+            stats['pops'] += 1
+            del engine.path[start:]
+        #the branch point becomes a level boundary so going back is cheap
+        for start, end in ((len(engine.path), common), (common, len(path))):
+            if start < end:
+                engine.backend.send('(push 1)')
+                engine.levels.append(start)
+                stats['pushes'] += 1
+                for frame in path[start:end]:
+                    engine.backend.send(frame.command)
+                    stats['commands'] += 1
+                engine.path.extend(path[start:end])
+        return stats
+
+#running batches of independent queries on several cores
+class TaskTimeout(Exception):
+    pass
+
+class TaskFailed(Exception):
+    pass
+
+def _check(solver):
+    return solver.check()
+
+def _worker(conn, engine, processes):
+    ''' Executor worker loop. Unpickled solvers land on the warm engines of
+        a worker-wide Scheduler instead of starting their own process. '''
+    import signal, sys, traceback
+    scheduler = Scheduler(engine, processes)
+    Solver.backends[engine] = scheduler._backend
+    def terminate(signum, frame):
+        scheduler.close()
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        while True:
+            task = conn.recv()
+            if task is None:
+                break
+            key, func, state = task
+            try:
+                solver = pickle.loads(state)
+                result = ('ok', func(solver))
+                del solver
+            except Exception, e:
+                result = ('error', '%s: %s\n%s'%(type(e).__name__, e, traceback.format_exc()))
+            conn.send((key, result))
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        scheduler.close()
+        conn.close()
+
+class Executor(object):
+    ''' Runs queries over many independent Solver states on a pool of worker
+        processes. Each worker keeps its own engines warm between tasks (see
+        Scheduler) so states sharing constraint prefixes reuse them.
+        A task is a solver plus a function applied to it in the worker; the
+        function must be picklable, i.e. defined at module level.
+    '''
+    def __init__(self, workers=None, engine='z3', processes=1, timeout=None):
+        '''
+            @param workers: number of worker processes (default: cpu count)
+            @param processes: engine processes owned by each worker
+            @param timeout: default seconds a task may run before its worker
+                            is killed and the task reported as TaskTimeout
+        '''
+        import multiprocessing
+        self._workers = workers or multiprocessing.cpu_count()
+        self._engine = engine
+        self._processes = processes
+        self.timeout = timeout
+        self._pool = []
+
+    def _spawn(self):
+        import multiprocessing
+        parent, child = multiprocessing.Pipe()
+        proc = multiprocessing.Process(target=_worker, args=(child, self._engine, self._processes))
+        proc.daemon = True
+        proc.start()
+        child.close()
+        return [proc, parent, None, None]    #process, conn, task, deadline
+
+    def _kill(self, worker):
+        proc, conn = worker[0], worker[1]
+        proc.terminate()
+        proc.join()
+        conn.close()
+
+    def close(self):
+        ''' Stops all the workers '''
+        for worker in self._pool:
+            try:
+                worker[1].send(None)
+            except IOError:
+                pass
+        for worker in self._pool:
+            worker[0].join(1)
+            if worker[0].is_alive():
+                worker[0].terminate()
+                worker[0].join()
+            worker[1].close()
+        self._pool = []
+
+    def map(self, func, solvers, timeout=None):
+        ''' Applies func to every solver on the workers and yields
+            (index, result) pairs as they complete. The result is a
+            TaskTimeout or TaskFailed instance if the task did not finish.
+            func defaults to Solver.check when None.
+            solvers is consumed lazily: no more than one task per worker is
+            pickled ahead of its result being taken, so a slow consumer
+            slows the producer down.
+        '''
+        if func is None:
+            func = _check
+        if timeout is None:
+            timeout = self.timeout
+        while len(self._pool) < self._workers:
+            self._pool.append(self._spawn())
+        try:
+            for result in self._map(func, enumerate(solvers), timeout):
+                yield result
+        finally:
+            #abandoned before the end, results still in flight are lost
+            for worker in self._pool:
+                if worker[2] is not None:
+                    self._kill(worker)
+            self._pool = [w for w in self._pool if w[2] is None]
+
+    def _map(self, func, tasks, timeout):
+        import select, time
+        pending = True
+        busy = 0
+        while pending or busy:
+            for worker in self._pool:
+                if worker[2] is None and pending:
+                    try:
+                        index, solver = next(tasks)
+                    except StopIteration:
+                        pending = False
+                        break
+                    worker[1].send((index, func, pickle.dumps(solver, pickle.HIGHEST_PROTOCOL)))
+                    worker[2] = index
+                    worker[3] = None if timeout is None else time.time() + timeout
+                    busy += 1
+            if not busy:
+                break
+
+            deadlines = [w[3] for w in self._pool if w[2] is not None and w[3] is not None]
+            wait = None if not deadlines else max(0, min(deadlines) - time.time())
+            ready, _, _ = select.select([w[1] for w in self._pool if w[2] is not None], [], [], wait)
+            now = time.time()
+            for i, worker in enumerate(self._pool):
+                if worker[2] is None:
+                    continue
+                index = worker[2]
+                if worker[1] in ready:
+                    try:
+                        key, (status, value) = worker[1].recv()
+                    except EOFError:
+                        status, value = 'error', 'worker died'
+                    if status != 'ok':
+                        value = TaskFailed(value)
+                    worker[2] = worker[3] = None
+                elif worker[3] is not None and now >= worker[3]:
+                    self._kill(worker)
+                    self._pool[i] = self._spawn()
+                    value = TaskTimeout('task %d took more than %s seconds'%(index, timeout))
+                else:
+                    continue
+                busy -= 1
+                yield index, value
+
+class _Future(object):
+    ''' The part of concurrent.futures.Future used here, for when the
+        futures backport is not installed. result() raises TaskTimeout if
+        the timeout expires.
+    '''
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._state = 'pending'
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def cancel(self):
+        with self._lock:
+            if self._state != 'pending':
+                return self._state == 'cancelled'
+            self._state = 'cancelled'
+        self._finish()
+        return True
+
+    def cancelled(self):
+        return self._state == 'cancelled'
+
+    def running(self):
+        return self._state == 'running'
+
+    def done(self):
+        return self._event.is_set()
+
+    def set_running_or_notify_cancel(self):
+        with self._lock:
+            if self._state == 'cancelled':
+                return False
+            self._state = 'running'
+        return True
+
+    def set_result(self, result):
+        self._result = result
+        self._state = 'finished'
+        self._finish()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._state = 'finished'
+        self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, fn):
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def exception(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise TaskTimeout('no result after %s seconds'%timeout)
+        if self._state == 'cancelled':
+            raise TaskFailed('cancelled')
+        return self._exception
+
+    def result(self, timeout=None):
+        exception = self.exception(timeout)
+        if exception is not None:
+            raise exception
+        return self._result
+
+Future = _futures.Future if _futures is not None else _Future
+
+class ThreadExecutor(object):
+    ''' Runs queries on live solvers from a pool of threads and hands back
+        Futures. Threads block on the engine pipes with the GIL released, so
+        queries on solvers with different engine processes (or sharing a
+        Scheduler) run at the same time. Every solver given to it is made
+        threadsafe: queries on the same solver take turns.
+    '''
+    def __init__(self, workers=4):
+        import Queue
+        self._tasks = Queue.Queue()
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                break
+            future, func, args, kwargs = task
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = func(*args, **kwargs)
+            except Exception, e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def submit(self, func, *args, **kwargs):
+        ''' Runs func(*args, **kwargs) on a pool thread, returns its Future '''
+        if self._threads is None:
+            raise RuntimeError('executor closed')
+        future = Future()
+        self._tasks.put((future, func, args, kwargs))
+        return future
+
+    def _query(self, solver, method, *args):
+        solver.threadsafe = True
+        return self.submit(getattr(solver, method), *args)
+
+    def check(self, solver):
+        return self._query(solver, 'check')
+
+    def getvalue(self, solver, val):
+        return self._query(solver, 'getvalue', val)
+
+    def minmax(self, solver, x, iters=10000):
+        return self._query(solver, 'minmax', x, iters)
+
+    def close(self, wait=True):
+        ''' Stops the threads once the queries submitted are done '''
+        if self._threads is None:
+            return
+        for thread in self._threads:
+            self._tasks.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+        self._threads = None
+
 #####################################
 
 def issymbolic(x):
@@ -883,6 +2962,10 @@ def OR(a, b):
     return a | b
 
 def UGT(a, b):
+    if isinstance(a, BitVec) or isinstance(b, BitVec):
+        decided = _decide('ugt', a, b)
+        if decided is not None:
+            return decided
     return {  (int, int): lambda : a > b if a>=0 and b>=0 else None,
               (long, int): lambda : a > b if a>=0 and b>=0 else None,
               (int, long): lambda : a > b if a>=0 and b>=0 else None,
@@ -895,6 +2978,10 @@ def UGT(a, b):
             }[(type(a),type(b))]()
 
 def UGE(a, b):
+    if isinstance(a, BitVec) or isinstance(b, BitVec):
+        decided = _decide('uge', a, b)
+        if decided is not None:
+            return decided
     return {  (int, int): lambda : a >= b if a>=0 and b>=0 else None,
               (long, int): lambda : a >= b if a>=0 and b>=0 else None,
               (int, long): lambda : a >= b if a>=0 and b>=0 else None,
@@ -908,6 +2995,10 @@ def UGE(a, b):
 
 
 def ULT(a, b):
+    if isinstance(a, BitVec) or isinstance(b, BitVec):
+        decided = _decide('ult', a, b)
+        if decided is not None:
+            return decided
     return {  (int, int): lambda : a < b if a>=0 and b>=0 else None,
               (long, int): lambda : a < b if a>=0 and b>=0 else None,
               (int, long): lambda : a < b if a>=0 and b>=0 else None,
@@ -920,6 +3011,10 @@ def ULT(a, b):
             }[(type(a),type(b))]()
 
 def ULE(a, b):
+    if isinstance(a, BitVec) or isinstance(b, BitVec):
+        decided = _decide('ule', a, b)
+        if decided is not None:
+            return decided
     return {  (int, int): lambda : a <= b if a>=0 and b>=0 else None,
               (long, int): lambda : a <= b if a>=0 and b>=0 else None,
               (int, long): lambda : a <= b if a>=0 and b>=0 else None,
@@ -987,15 +3082,9 @@ def ITEBV(size, cond, true, false):
             return false
     assert type(cond) is Bool
     if type(true) in (int,long):
-        if size == 1:
-            true = BitVec(size, '#'+bin(true&1)[1:], solver=cond.solver)
-        else:
-            true = BitVec(size, '#x%0*x'%(size/4, true&((1<<size)-1)), solver=cond.solver)
+        true = _bvconst(size, true, cond.solver)
     if type(false) in (int,long):
-        if size == 1:
-            false = BitVec(size, '#'+bin(false&1)[1:], solver=cond.solver)
-        else:
-            false = BitVec(size, '#x%0*x'%(size/4, false&((1<<size)-1)), solver=cond.solver)
+        false = _bvconst(size, false, cond.solver)
     return BitVec(size, 'ite', cond, true, false, solver=cond.solver)
 
 def CONCAT(size, *args):
@@ -1009,9 +3098,7 @@ def CONCAT(size, *args):
                     break
             def cast(x):
                 if type(x) in (int,long):
-                    if size ==1:
-                        return BitVec(size, '#'+bin(x&1)[1:], solver=solver)
-                    return BitVec(size, '#x%0*x'%(size/4, x&((1<<size)-1)), solver=solver)
+                    return _bvconst(size, x, solver)
                 return x
             return BitVec(size*len(args), 'concat', *map(cast,args), solver=solver)
         else:
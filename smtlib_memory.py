@@ -0,0 +1,322 @@
+# Copyright (c) 2013, Felipe Andres Manzano
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice,this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the copyright holder nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+''' Paged symbolic memory.
+
+    A Memory models a byte addressable address space on top of a Solver.
+    Concrete bytes live in plain pages (bytearray, or read-only str/mmap
+    buffers) and only the bytes written with symbolic values are kept as
+    BitVec overlays, so reading concrete memory never builds a term and a
+    read touching symbolic bytes only mentions those.
+
+    >>> m = Memory(solver)
+    >>> m.map(0x1000, 0x2000)
+    >>> m.write(0x1000, 0x41424344, 4)
+    >>> m.read(0x1000, 4)
+    1094861636
+
+    Forked memories share their pages until one of them writes to a page
+    (copy on write).
+'''
+import mmap
+
+from smtlib import Array, BitVec, CONCAT, EXTRACT, ITEBV, OR, _auxdeps, _constant
+
+class MemoryException(Exception):
+    ''' An access to an unmapped address '''
+    def __init__(self, message, address):
+        super(MemoryException, self).__init__('%s <0x%x>'%(message, address))
+        self.address = address
+
+class _Page(object):
+    __slots__ = ('data', 'symbols')
+
+    def __init__(self, data, symbols=None):
+        #a bytearray, or a read-only str/buffer until the first write
+        self.data = data
+        #offset -> symbolic byte written there
+        self.symbols = symbols
+
+class Memory(object):
+    page_size = 1<<12
+    #symbolic addresses with at most this many candidates become ite chains
+    ite_limit = 16
+    #wider symbolic reads go through an Array storing at most this many
+    #non zero bytes, beyond that the address is concretized
+    array_limit = 1<<12
+
+    def __init__(self, solver, bits=32):
+        self.solver = solver
+        self.bits = bits
+        self._pages = {}
+        #the pages this memory does not share with a fork
+        self._owned = set()
+
+    def __getstate__(self):
+        state = {}
+        state['solver'] = self.solver
+        state['bits'] = self.bits
+        state['pages'] = dict((n, (str(p.data), p.symbols)) for n, p in self._pages.iteritems())
+        return state
+
+    def __setstate__(self, state):
+        self.solver = state['solver']
+        self.bits = state['bits']
+        self._pages = dict((n, _Page(data, symbols)) for n, (data, symbols) in state['pages'].iteritems())
+        self._owned = set()
+
+    def fork(self):
+        ''' Returns a copy of this memory sharing every page until written '''
+        other = Memory(self.solver, self.bits)
+        other._pages = dict(self._pages)
+        self._owned = set()
+        return other
+
+    def _wrap(self, address):
+        return address & ((1<<self.bits)-1)
+
+    def map(self, address, size, data=None):
+        ''' Maps size bytes at the page aligned address. The pages are zero
+            filled or hold data (a str, bytearray or mmap) which is shared,
+            not copied, so it should not change afterwards.
+        '''
+        assert address % self.page_size == 0
+        zero = '\0'*self.page_size
+        for offset in xrange(0, size, self.page_size):
+            if data is None or offset >= len(data):
+                chunk = zero
+            else:
+                chunk = buffer(data, offset, self.page_size)
+                if len(chunk) < self.page_size:
+                    chunk = bytearray(chunk) + bytearray(self.page_size - len(chunk))
+            pageno = (address + offset) // self.page_size
+            self._pages[pageno] = _Page(chunk)
+            self._owned.discard(pageno)
+
+    def map_file(self, address, f, offset=0, size=0):
+        ''' Maps size bytes (the whole file if 0) of the open file f from
+            offset at address. The file is mapped read-only; written pages
+            are copied.
+        '''
+        region = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ, offset=offset)
+        self.map(address, len(region), region)
+
+    def unmap(self, address, size):
+        assert address % self.page_size == 0
+        for offset in xrange(0, size, self.page_size):
+            pageno = (address + offset) // self.page_size
+            self._pages.pop(pageno, None)
+            self._owned.discard(pageno)
+
+    def mapped(self, address):
+        return self._wrap(address) // self.page_size in self._pages
+
+    def _page(self, address, write=False):
+        pageno = address // self.page_size
+        page = self._pages.get(pageno)
+        if page is None:
+            raise MemoryException("Unmapped memory", address)
+        if write and pageno not in self._owned:
+            symbols = dict(page.symbols) if page.symbols else None
+            page = _Page(bytearray(page.data), symbols)
+            self._pages[pageno] = page
+            self._owned.add(pageno)
+        return page
+
+    #concrete addresses
+    def _load(self, address, nbytes):
+        ''' The bytes at address, ints or BitVecs where symbolic '''
+        values = []
+        while nbytes:
+            address = self._wrap(address)
+            offset = address % self.page_size
+            count = min(nbytes, self.page_size - offset)
+            page = self._page(address)
+            chunk = list(bytearray(page.data[offset:offset+count]))
+            if page.symbols:
+                for i in xrange(count):
+                    if offset + i in page.symbols:
+                        chunk[i] = page.symbols[offset + i]
+            values.extend(chunk)
+            address += count
+            nbytes -= count
+        return values
+
+    def _store(self, address, values):
+        for value in values:
+            address = self._wrap(address)
+            page = self._page(address, write=True)
+            offset = address % self.page_size
+            if isinstance(value, BitVec):
+                if page.symbols is None:
+                    page.symbols = {}
+                page.symbols[offset] = value
+            else:
+                page.data[offset] = value
+                if page.symbols:
+                    page.symbols.pop(offset, None)
+            address += 1
+
+    def read(self, address, nbytes, endian='little'):
+        ''' Reads nbytes at address as one nbytes*8 bits value: an int if
+            every byte is concrete, a term over the symbolic bytes otherwise.
+            @param address: an int or a BitVec
+            @param endian: 'little' or 'big'
+        '''
+        assert endian in ('little', 'big')
+        address = self._concrete(address)
+        if isinstance(address, BitVec):
+            return self._read_symbolic(address, nbytes, endian)
+        values = self._load(address, nbytes)
+        if endian == 'little':
+            values.reverse()
+        return CONCAT(8, *values)
+
+    def write(self, address, value, nbytes, endian='little'):
+        ''' Writes the nbytes*8 bits value (an int or a BitVec) at address.
+            @param address: an int or a BitVec
+            @param endian: 'little' or 'big'
+        '''
+        assert endian in ('little', 'big')
+        values = [EXTRACT(value, 8*i, 8) for i in xrange(nbytes)]
+        if endian == 'big':
+            values.reverse()
+        address = self._concrete(address)
+        if isinstance(address, BitVec):
+            self._write_symbolic(address, values)
+        else:
+            self._store(address, values)
+
+    #symbolic addresses
+    def _concrete(self, address):
+        if isinstance(address, BitVec):
+            value = _constant(address.value)
+            if value is not None:
+                return value
+            lo, hi = address.bounds
+            if lo == hi:
+                return lo
+        return address
+
+    def _concretize(self, address):
+        ''' Fixes a symbolic address to one feasible value '''
+        value = self.solver.getvalue(address)
+        self.solver.add(address == value)
+        return value
+
+    def _candidates(self, address, nbytes):
+        ''' The mapped addresses a symbolic address may take, None if more
+            than ite_limit.
+        '''
+        lo, hi = address.bounds
+        if hi - lo + 1 > self.ite_limit:
+            return None
+        return [a for a in xrange(lo, hi+1)
+                  if self.mapped(a) and self.mapped(a + nbytes - 1)]
+
+    def _restrict(self, address, candidates):
+        ''' Constrains address to the candidates if it may also take an
+            unmapped one, which would otherwise get the last candidate.
+        '''
+        lo, hi = address.bounds
+        if len(candidates) < hi - lo + 1:
+            self.solver.add(reduce(OR, [address == a for a in candidates]))
+
+    def _restrict_pages(self, address, nbytes):
+        ''' Constrains address so the nbytes read from it are all mapped,
+            the array would read the unmapped ones as zero.
+        '''
+        lo, hi = address.bounds
+        runs = []
+        for n in sorted(self._pages):
+            start, end = n*self.page_size, (n+1)*self.page_size - 1
+            if runs and runs[-1][1] + 1 == start:
+                runs[-1][1] = end
+            else:
+                runs.append([start, end])
+        #where a read may start within each run of mapped pages
+        runs = [(max(start, lo), min(end - nbytes + 1, hi)) for start, end in runs]
+        runs = [(start, end) for start, end in runs if start <= end]
+        if not runs:
+            raise MemoryException("Unmapped memory", lo)
+        if runs != [(lo, hi)]:
+            self.solver.add(reduce(OR, [address.uge(start) & address.ule(end) for start, end in runs]))
+
+    def _read_symbolic(self, address, nbytes, endian):
+        candidates = self._candidates(address, nbytes)
+        if candidates is None:
+            array = self._array(address, nbytes)
+            if array is None:
+                return self.read(self._concretize(address), nbytes, endian)
+            self._restrict_pages(address, nbytes)
+            return array.read(address, nbytes, endian)
+        if not candidates:
+            raise MemoryException("Unmapped memory", address.bounds[0])
+        self._restrict(address, candidates)
+        result = self.read(candidates[-1], nbytes, endian)
+        for a in reversed(candidates[:-1]):
+            result = ITEBV(nbytes*8, address == a, self.read(a, nbytes, endian), result)
+        return result
+
+    def _array(self, address, nbytes):
+        ''' An Array holding the mapped bytes address may reach, None if
+            more than array_limit of them are not zero.
+        '''
+        lo, hi = address.bounds
+        hi = min(hi + nbytes - 1, (1<<self.bits)-1)
+        stores = []
+        for n in sorted(self._pages):
+            if lo // self.page_size <= n <= hi // self.page_size:
+                base = n*self.page_size
+                stores.extend((base + i, value) for i, value in enumerate(self._load(base, self.page_size))
+                                                  if isinstance(value, BitVec) or value)
+                if len(stores) > self.array_limit:
+                    return None
+        #zero filled so only the other bytes are stored, the whole chain is
+        #built as text at once instead of one term per store
+        sort = '(Array (_ BitVec %d) (_ BitVec 8))'%self.bits
+        text = ['(store '*len(stores), '((as const %s) #x00)'%sort]
+        for key, value in stores:
+            if isinstance(value, BitVec):
+                text.append(' #x%0*x %s)'%(self.bits/4, key, value))
+            else:
+                text.append(' #x%0*x #x%02x)'%(self.bits/4, key, value))
+        symbols = [value for key, value in stores if isinstance(value, BitVec)]
+        return Array(self.bits, ''.join(text), solver=self.solver, aux=_auxdeps(symbols))
+
+    def _write_symbolic(self, address, values):
+        candidates = self._candidates(address, len(values))
+        if candidates is None:
+            self._store(self._concretize(address), values)
+            return
+        if not candidates:
+            raise MemoryException("Unmapped memory", address.bounds[0])
+        self._restrict(address, candidates)
+        for a in candidates:
+            old = self._load(a, len(values))
+            self._store(a, [ITEBV(8, address == a, new, prev) for new, prev in zip(values, old)])
@@ -0,0 +1,262 @@
+# Copyright (c) 2013, Felipe Andres Manzano
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice,this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the copyright holder nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+''' A local solver server and its client.
+
+    The server hosts a bounded set of engine processes (see Scheduler) and
+    keeps the state of every connected RemoteSolver resident, so a client
+    only ever sends what changed since its last command.
+
+    $ python smtlib_server.py --unix /tmp/smtlib.sock
+    $ python smtlib_server.py --tcp 127.0.0.1:7373
+
+    >>> s = RemoteSolver('/tmp/smtlib.sock')
+    >>> s = RemoteSolver(('127.0.0.1', 7373))
+
+    Wire format: every message is a frame made of a one byte kind, a 4 byte
+    big endian length and the payload. A client says hello ('H', engine
+    name), then sends commands ('S', smtlib text) which get no answer and
+    asks for responses ('R') answered with data ('D') or an error ('E').
+    Engines are shared: a query keeps its engine until the client reads the
+    response, so up to `processes` queries run at the same time.
+'''
+import functools
+import os
+import socket
+import SocketServer
+import struct
+import threading
+
+from smtlib import Backend, Solver, Scheduler, ScheduledBackend, logger
+
+_header = struct.Struct('>cI')
+
+def _recvall(sock, size):
+    chunks = []
+    while size:
+        data = sock.recv(min(size, 1<<16))
+        if not data:
+            raise EOFError()
+        chunks.append(data)
+        size -= len(data)
+    return ''.join(chunks)
+
+def _recvframe(sock):
+    kind, size = _header.unpack(_recvall(sock, _header.size))
+    return kind, _recvall(sock, size)
+
+def _frame(kind, payload=''):
+    return _header.pack(kind, len(payload)) + payload
+
+def _connect(address):
+    if isinstance(address, basestring):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.connect(address)
+    return sock
+
+#server
+class _Handler(SocketServer.BaseRequestHandler):
+    ''' One client connection holding one solver state '''
+    def handle(self):
+        server = self.server
+        backend = None
+        error = None
+        try:
+            while True:
+                kind, payload = _recvframe(self.request)
+                try:
+                    if kind == 'H':
+                        with server.lock:
+                            backend = server.session(payload)
+                    elif kind == 'S':
+                        #a query reserves an engine until its response is read
+                        backend.send(payload)
+                    elif kind == 'R':
+                        if error is not None:
+                            raise error
+                        reply = _frame('D', backend.recv())
+                except Exception, e:
+                    logger.exception('smtlib server')
+                    if kind != 'R':
+                        error = e
+                        continue
+                    error = None
+                    reply = _frame('E', '%s: %s'%(type(e).__name__, e))
+                if kind == 'R':
+                    self.request.sendall(reply)
+        except (EOFError, socket.error):
+            pass
+        finally:
+            if backend is not None:
+                backend.stop()
+
+class _Server(SocketServer.ThreadingMixIn):
+    def session(self, engine):
+        ''' Returns the backend of a new client state '''
+        if engine not in self.schedulers:
+            self.schedulers[engine] = Scheduler(engine, self.processes)
+        backend = ScheduledBackend(self.schedulers[engine], Solver._config[engine])
+        backend.start()
+        return backend
+
+    def process_request(self, request, client_address):
+        thread = threading.Thread(target=self.process_request_thread, args=(request, client_address))
+        thread.daemon = True
+        self.clients[thread] = request
+        thread.start()
+
+    def process_request_thread(self, request, client_address):
+        try:
+            SocketServer.ThreadingMixIn.process_request_thread(self, request, client_address)
+        finally:
+            self.clients.pop(threading.current_thread(), None)
+
+    def server_close(self):
+        SocketServer.TCPServer.server_close(self)
+        if isinstance(self.server_address, basestring):
+            os.unlink(self.server_address)
+        #hang up on the clients still connected
+        for thread, request in self.clients.items():
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            thread.join()
+        for scheduler in self.schedulers.values():
+            scheduler.close()
+
+class _UnixServer(_Server, SocketServer.UnixStreamServer):
+    pass
+
+class _TCPServer(_Server, SocketServer.TCPServer):
+    allow_reuse_address = True
+
+def make_server(address, processes=4):
+    ''' Builds a server listening on address: a path for a unix socket or
+        a (host, port) tuple for TCP. Call serve_forever() on it to run it.
+        @param processes: engine processes per engine kind
+    '''
+    if isinstance(address, basestring):
+        server = _UnixServer(address, _Handler)
+    else:
+        server = _TCPServer(address, _Handler)
+    server.processes = processes
+    server.schedulers = {}
+    server.clients = {}
+    server.lock = threading.Lock()
+    return server
+
+#client
+class RemoteBackend(Backend):
+    ''' Talks to an engine hosted by a solver server. Commands are buffered
+        and only written when a response is needed or the buffer is big.
+    '''
+    flush_size = 1<<16
+
+    def __init__(self, address, engine, config):
+        super(RemoteBackend, self).__init__(config)
+        self._address = address
+        self._engine = engine
+        self._sock = None
+        self._buffer = []
+        self._size = 0
+
+    def start(self):
+        self._sock = _connect(self._address)
+        self._sock.sendall(_frame('H', self._engine))
+
+    def stop(self):
+        if self._sock is None:
+            return
+        try:
+            self._flush()
+        except socket.error:
+            pass
+        self._sock.close()
+        self._sock = None
+
+    def alive(self):
+        return self._sock is not None
+
+    def _flush(self):
+        if self._buffer:
+            self._sock.sendall(''.join(self._buffer))
+            self._buffer = []
+            self._size = 0
+
+    def send(self, cmd):
+        self._buffer.append(_frame('S', cmd))
+        self._size += len(cmd)
+        if self._size >= self.flush_size:
+            self._flush()
+
+    def recv(self):
+        self._buffer.append(_frame('R'))
+        self._flush()
+        try:
+            kind, payload = _recvframe(self._sock)
+        except (EOFError, socket.error):
+            self._sock.close()
+            self._sock = None
+            return ''
+        if kind == 'E':
+            return '(error "%s")'%payload.replace('"', '""')
+        return payload
+
+class RemoteSolver(Solver):
+    ''' A Solver whose engine lives in a solver server '''
+    def __init__(self, address, engine='z3'):
+        super(RemoteSolver, self).__init__(engine, backend=functools.partial(RemoteBackend, address, engine))
+
+    def __getstate__(self):
+        state = super(RemoteSolver, self).__getstate__()
+        state['backend'] = self._backend_factory
+        return state
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Serve pooled SMT engines to RemoteSolver clients')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--unix', help='path of the unix socket to listen on')
+    group.add_argument('--tcp', help='host:port to listen on')
+    parser.add_argument('--processes', type=int, default=4, help='engine processes per engine kind')
+    args = parser.parse_args()
+    if args.unix:
+        address = args.unix
+    else:
+        host, port = args.tcp.rsplit(':', 1)
+        address = (host, int(port))
+    server = make_server(address, args.processes)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,240 @@
+# Copyright (c) 2013, Felipe Andres Manzano
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice,this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the copyright holder nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+''' Recording solver traffic and replaying it offline.
+
+    A Recorder attached to Solver.recorder writes every command sent to an
+    engine and every response read back, with the time each response took,
+    to an append-only trace file. Any number of solvers may share one
+    recorder; each solver records in its own session, and every engine
+    (re)initialization starts that session again.
+
+    >>> Solver.recorder = Recorder('run.trace')
+
+    The trace is re-executed against any configured engine, checking every
+    response against the recorded one:
+
+    $ python smtlib_trace.py run.trace --engine yices
+
+    File format: a magic line followed by records made of a one byte kind,
+    a 4 byte session, an 8 byte double and a 4 byte length, all big endian,
+    and the payload. Kinds are 'S' engine started (payload is the engine
+    name, followed by ' unsat-core' for the scratch engine of an unsat
+    core query; the double is a timestamp), 'C' command (timestamp) and 'R' response
+    (the double is the seconds since the last command of the session).
+    Lowercase kinds hold a zlib compressed payload.
+'''
+import struct
+import threading
+import time
+import weakref
+import zlib
+
+from smtlib import Solver
+
+MAGIC = 'SMTTRACE1\n'
+_record = struct.Struct('>cIdI')
+
+class Recorder(object):
+    ''' Appends solver traffic to a trace file '''
+    #payloads at least this long are compressed
+    compress_size = 256
+
+    def __init__(self, filename):
+        self._file = open(filename, 'ab')
+        self._last = 0
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+        else:
+            #appending, the sessions already in the file are taken
+            self._last = max([session for _, session, _, _ in read(filename)] or [0])
+        self._lock = threading.Lock()
+        self._sessions = weakref.WeakKeyDictionary()
+        self._sent = {}
+
+    def _write(self, kind, session, value, payload):
+        if len(payload) >= self.compress_size:
+            packed = zlib.compress(payload)
+            if len(packed) < len(payload):
+                kind, payload = kind.lower(), packed
+        self._file.write(_record.pack(kind, session, value, len(payload)))
+        self._file.write(payload)
+
+    def _start(self, solver, engine=None):
+        session = self._sessions.get(solver)
+        if session is None:
+            self._last += 1
+            session = self._sessions[solver] = self._last
+        self._write('S', session, time.time(), engine or solver._engine)
+        return session
+
+    def _session(self, solver):
+        #solvers started before the recorder was set get a session lazily
+        session = self._sessions.get(solver)
+        if session is None:
+            session = self._start(solver)
+        return session
+
+    def started(self, solver, engine=None):
+        ''' The engine of solver was (re)initialized: starts its session again
+            @param solver: whatever owns the engine, usually a Solver
+            @param engine: the engine name, solver._engine if None
+        '''
+        with self._lock:
+            self._start(solver, engine)
+
+    def sent(self, solver, cmd):
+        with self._lock:
+            session = self._session(solver)
+            self._sent[session] = now = time.time()
+            self._write('C', session, now, cmd)
+
+    def received(self, solver, response):
+        with self._lock:
+            session = self._session(solver)
+            elapsed = time.time() - self._sent.get(session, time.time())
+            self._write('R', session, elapsed, response)
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+def read(filename):
+    ''' Iterates the (kind, session, value, payload) records of a trace '''
+    with open(filename, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise Exception("Not a solver trace: %s"%filename)
+        while True:
+            header = f.read(_record.size)
+            if len(header) < _record.size:
+                #a truncated last record is what a crashed run leaves
+                return
+            kind, session, value, size = _record.unpack(header)
+            payload = f.read(size)
+            if len(payload) < size:
+                return
+            if kind.islower():
+                kind, payload = kind.upper(), zlib.decompress(payload)
+            yield kind, session, value, payload
+
+def _config(engine, options=()):
+    config = dict(Solver._config[engine])
+    for option in options:
+        config.update(config[option])
+    return config
+
+def _start(engine, options=()):
+    config = _config(engine, options)
+    backend = config['backend'](config)
+    backend.start()
+    return backend
+
+def replay(filename, engine=None):
+    ''' Re-executes a trace and returns one dict per query with the keys
+        session, query, expected, response, match, recorded and latency
+        (the seconds the recorded and the replayed response took).
+        @param engine: the engine to replay on, the recorded one if None.
+                       The recorded engine initialization is swapped for
+                       the one of this engine.
+    '''
+    sessions = {}
+    results = []
+    try:
+        for kind, sid, value, payload in read(filename):
+            if kind == 'S':
+                session = sessions.get(sid)
+                payload, options = payload.split(' ')[0], payload.split(' ')[1:]
+                target = engine or payload
+                #a session also starts again after a (reset), keep that engine
+                if session is None or session['last'] != '(reset)':
+                    #otherwise the engine was restarted
+                    if session is not None:
+                        session['backend'].stop()
+                    session = {'backend': _start(target, options), 'last': None, 'sent': time.time()}
+                    sessions[sid] = session
+                session['skip'] = []
+                if target != payload:
+                    for cmd in _config(target, options)['init']:
+                        session['backend'].send(cmd)
+                    session['skip'] = list(_config(payload, options)['init'])
+                session['target'] = target
+            elif kind == 'C':
+                session = sessions[sid]
+                if session['skip'] and session['skip'][0] == payload:
+                    session['skip'].pop(0)
+                    continue
+                session['skip'] = []
+                session['last'] = payload
+                session['sent'] = time.time()
+                if payload == '(reset)' and not Solver._config[session['target']]['support-reset']:
+                    session['backend'].stop()
+                    session['backend'] = _start(session['target'])
+                    continue
+                session['backend'].send(payload)
+            elif kind == 'R':
+                session = sessions[sid]
+                response = session['backend'].recv()
+                latency = time.time() - session['sent']
+                results.append({'session': sid,
+                                'query': session['last'],
+                                'expected': payload,
+                                'response': response,
+                                'match': response == payload,
+                                'recorded': value,
+                                'latency': latency})
+    finally:
+        for session in sessions.values():
+            session['backend'].stop()
+    return results
+
+def summary(results):
+    ''' Totals of a replay '''
+    return {'queries': len(results),
+            'mismatches': sum(1 for r in results if not r['match']),
+            'recorded': sum(r['recorded'] for r in results),
+            'latency': sum(r['latency'] for r in results)}
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Replay a solver trace and compare responses and latencies')
+    parser.add_argument('trace', help='trace file written by a Recorder')
+    parser.add_argument('--engine', choices=sorted(Solver._config), help='engine to replay on (default: the recorded one)')
+    parser.add_argument('--quiet', action='store_true', help='only print the totals')
+    args = parser.parse_args()
+    results = replay(args.trace, args.engine)
+    if not args.quiet:
+        print '%7s %10s %10s %10s  %s'%('session', 'recorded', 'replayed', 'diff', 'query')
+        for r in results:
+            print '%7d %10.6f %10.6f %+10.6f %s %s'%(r['session'], r['recorded'], r['latency'],
+                                                    r['latency'] - r['recorded'],
+                                                    ' ' if r['match'] else '!',
+                                                    (r['query'] or '')[:60].replace('\n', ' '))
+    totals = summary(results)
+    print '%d queries, %d mismatches, recorded %.6fs, replayed %.6fs'%(totals['queries'], totals['mismatches'],
+                                                                       totals['recorded'], totals['latency'])
@@ -26,16 +26,29 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 from smtlib import *
+import smtlib
 # from smtlibv2 import CVC4Solver as Solver
 import unittest
 import fcntl
 import resource
 import gc
 import sys
+import pickle
+import os
+import shutil
+import tempfile
 #logging.basicConfig(filename = "test.log",
 #                format = "%(asctime)s: %(name)s:%(levelname)s: %(message)s",
 #                level = logging.DEBUG)
 
+def _getvalue(s):
+    assert s.check() == 'sat'
+    return s.getvalue(s.input_symbols[0][0])
+
+def _sleep(s):
+    import time
+    time.sleep(10)
+
 class ExpressionTest(unittest.TestCase):
     def get_open_fds(self):
         fds = []
@@ -49,10 +62,15 @@ class ExpressionTest(unittest.TestCase):
 
     def setUp(self):
         self.fds = self.get_open_fds()
+        #probes are cached out of the user cache
+        self.cache = Solver.capabilities_cache
+        Solver.capabilities_cache = os.path.join(tempfile.mkdtemp(), 'capabilities')
 
         self.engine = 'z3'
 
     def tearDown(self):
+        shutil.rmtree(os.path.dirname(Solver.capabilities_cache))
+        Solver.capabilities_cache = self.cache
         gc.collect()
         gc.garbage = []
         self.assertEqual(self.fds, self.get_open_fds())
@@ -178,6 +196,62 @@ class ExpressionTest(unittest.TestCase):
         self.checkLeak(s)
 
 
+    def testArray_readwrite(self):
+        s = Solver(self.engine)
+        array = s.mkArray(32)
+        key = s.mkBitVec(32)
+        value = s.mkBitVec(32)
+        array.write(0x1000, 0x41424344, 4)
+        self.assertEqual(array.read(0x1000, 4), 0x41424344)
+        self.assertEqual(array.read(0x1000, 4, 'big'), 0x44434241)
+        self.assertEqual(array.read(0x1001, 2), 0x4243)
+        #writes only drop the cached reads they may alias
+        other = array[0x2000]
+        array.write(0x1000, 0, 2)
+        self.assertTrue(array[0x2000] is other)
+        self.assertEqual(array.read(0x1000, 4), 0x41420000)
+        array.write(key, value, 4, 'big')
+        self.assertFalse(0x2000 in array.cache)
+        word = array.read(key, 4, 'big')
+        self.assertEqual(word.size, 32)
+        s.add(word != value)
+        self.assertEqual(s.check(), 'unsat')
+
+    def testArray_symbolic_read(self):
+        s = Solver(self.engine)
+        array = s.mkArray(32)
+        key = s.mkBitVec(32)
+        array.write(0, 0x41424344, 4)
+        array.write(0x100, 0x45464748, 4)
+        #a wide key is a plain select
+        value = array[key + 8]
+        self.assertEqual(array.stats['select'], 1)
+        s.push()
+        s.add(key.ult(4))
+        value = array[key]
+        self.assertEqual(array.stats['ite'], 1)
+        self.assertTrue(value.value.startswith('(ite'))
+        s.add(value == 0x42)
+        self.assertEqual(s.getvalue(key), 2)
+        s.pop()
+        #reads picked under popped constraints are not cached
+        array[key]
+        self.assertEqual(array.stats['select'], 2)
+        other = s.mkBitVec(32)
+        s.add(other == 0x101)
+        self.assertEqual(array[other].value, '#x47')
+        self.assertEqual(array.stats['concretize'], 1)
+        #the policy can be replaced
+        array.read_strategy = lambda key, lo, hi: 'select'
+        array[key + 1]
+        self.assertEqual(array.stats['select'], 3)
+        array.read_strategy = lambda key, lo, hi: 'bisect'
+        self.assertRaises(Exception, array.__getitem__, key + 2)
+        #each array counts its own reads
+        self.assertEqual(s.mkArray(32).stats['select'], 0)
+        s1, array1 = pickle.loads(pickle.dumps((s, array)))
+        self.assertEqual(array1.stats, array.stats)
+
     def testBasicPickle(self):
         import pickle
         s = Solver(self.engine)
@@ -641,6 +715,635 @@ class ExpressionTest(unittest.TestCase):
         self.assertEqual(constrs[0], '(assert (= A B))')
         self.checkLeak(s)
 
+    def testSolver_collect(self):
+        s = Solver(self.engine)
+        a = s.mkBitVec(32, 'A')
+        x = a
+        for i in range(12):
+            x = x * a + i
+        y = x + 1
+        n = len(s.declarations)
+        self.assertTrue(n > 1)
+        #still referenced by y
+        del x
+        self.assertEqual(s.collect()['declarations'], 0)
+        self.assertEqual(len(s.declarations), n)
+        del y
+        report = s.collect()
+        self.assertEqual(report['declarations'], n - 1)
+        self.assertEqual(report['constraints'], n - 1)
+        self.assertTrue(report['bytes'] > 0)
+        self.assertEqual(len(s.declarations), 1)
+        self.assertEqual(s.constraints, [])
+        self.assertEqual(s.check(), 'sat')
+        self.checkLeak(s)
+
+    def testSolver_collect_constraint(self):
+        s = Solver(self.engine)
+        a = s.mkBitVec(32, 'A')
+        x = a
+        for i in range(12):
+            x = x * a + i
+        s.add(x == x)
+        n = len(s.declarations)
+        del x
+        self.assertEqual(s.collect()['declarations'], 0)
+        s = pickle.loads(pickle.dumps(s))
+        self.assertEqual(s.collect()['declarations'], 0)
+        self.assertEqual(len(s.declarations), n)
+        self.assertEqual(s.check(), 'sat')
+        self.checkLeak(s)
+
+    def testSolver_replay_stack(self):
+        s = Solver(self.engine)
+        a = s.mkBitVec(32)
+        b = s.mkBitVec(32)
+        s.add(a == 1)
+        s.push()
+        s.add(b == a)
+        s.push()
+        s.add(b == 2)
+        self.assertEqual(s.check(), 'unsat')
+        s = pickle.loads(pickle.dumps(s))
+        self.assertEqual(s.check(), 'unsat')
+        s.pop()
+        self.assertEqual(s.check(), 'sat')
+        self.assertEqual(s.getvalue(b), 1)
+        s.pop()
+        s.add(b == 2)
+        self.assertEqual(s.check(), 'sat')
+        self.checkLeak(s)
+
+    def testSolver_reset(self):
+        s = Solver(self.engine)
+        a = s.mkBitVec(32)
+        s.add(a == 1)
+        s.push()
+        s.add(a == 2)
+        self.assertEqual(s.check(), 'unsat')
+        backend = s._backend
+        #nothing changed, nothing to do
+        s.reset()
+        self.assertTrue(s._backend is backend)
+        self.assertEqual(s.check(), 'unsat')
+        #engine crash
+        s._stop_proc()
+        s.reset()
+        self.assertEqual(s.check(), 'unsat')
+        s.pop()
+        self.assertEqual(s.check(), 'sat')
+        self.checkLeak(s)
+
+    def testScheduler(self):
+        scheduler = Scheduler(self.engine, processes=1)
+        s = scheduler.solver()
+        a = s.mkBitVec(32)
+        s.add(a.ult(100))
+        self.assertEqual(s.check(), 'sat')
+        s.push()
+        s.add(a == 5)
+        self.assertEqual(s.getvalue(a), 5)
+        s.pop()
+        s.push()
+        s.add(a == 200)
+        self.assertEqual(s.check(), 'unsat')
+        #another state shares the engine
+        t = scheduler.solver()
+        b = t.mkBitVec(32)
+        t.add(b == 3)
+        self.assertEqual(t.check(), 'sat')
+        self.assertEqual(t.getvalue(b), 3)
+        #back to the first one
+        self.assertEqual(s.check(), 'unsat')
+        s.pop()
+        self.assertEqual(s.check(), 'sat')
+        pushes = scheduler.stats['pushes']
+        self.assertEqual(s.check(), 'sat')
+        self.assertEqual(scheduler.stats['pushes'], pushes)
+        del s, t
+        scheduler.close()
+
+    def testScheduler_siblings(self):
+        scheduler = Scheduler(self.engine, processes=2)
+        s = scheduler.solver()
+        a = s.mkBitVec(32)
+        for i in range(10):
+            s.add(a != i)
+        s.push()
+        s.add(a.ult(3))
+        self.assertEqual(s.check(), 'unsat')
+        s.pop()
+        s.push()
+        s.add(a == 30)
+        self.assertEqual(s.check(), 'sat')
+        commands = scheduler.stats['commands']
+        s.pop()
+        s.push()
+        s.add(a == 31)
+        self.assertEqual(s.check(), 'sat')
+        #only the differing suffix was sent
+        self.assertEqual(scheduler.stats['commands'], commands + 1)
+        s.pop()
+        del s
+        scheduler.close()
+
+    def testExecutor(self):
+        solvers = []
+        for i in range(10):
+            s = Solver(self.engine)
+            a = s.mkBitVec(32, is_input=True)
+            s.add(a == i)
+            solvers.append(s)
+        executor = Executor(workers=2, engine=self.engine)
+        try:
+            results = dict(executor.map(_getvalue, iter(solvers)))
+            self.assertEqual(results, dict((i, i) for i in range(10)))
+            results = dict(executor.map(None, solvers[:2]))
+            self.assertEqual(results, {0: 'sat', 1: 'sat'})
+            results = dict(executor.map(_sleep, solvers[:1], timeout=0.2))
+            self.assertTrue(isinstance(results[0], TaskTimeout))
+            results = dict(executor.map(len, solvers[:1]))
+            self.assertTrue(isinstance(results[0], TaskFailed))
+        finally:
+            executor.close()
+
+    def testThreadExecutor(self):
+        solvers = []
+        for i in range(4):
+            s = Solver(self.engine)
+            a = s.mkBitVec(32)
+            s.add(a.ugt(i))
+            s.add(a.ult(100))
+            solvers.append((s, a))
+        executor = ThreadExecutor(workers=3)
+        try:
+            checks = [executor.check(s) for s, a in solvers]
+            values = [executor.getvalue(s, a) for s, a in solvers]
+            bounds = [executor.minmax(s, a) for s, a in solvers]
+            self.assertEqual([f.result() for f in checks], ['sat'] * 4)
+            for i, f in enumerate(values):
+                self.assertTrue(i < f.result() < 100)
+            self.assertEqual([f.result() for f in bounds], [(i + 1, 99) for i in range(4)])
+            self.assertTrue(all(s.threadsafe for s, a in solvers))
+            failed = executor.submit(len, 1)
+            self.assertRaises(TypeError, failed.result)
+            self.assertTrue(isinstance(failed.exception(), TypeError))
+            #queries on one solver from many threads do not interleave
+            s, a = solvers[0]
+            b = s.mkBitVec(32)
+            s.add(b == a + 1)
+            def query():
+                for i in range(10):
+                    x, y = s.getvalue(a), s.getvalue(b)
+                    assert s.must_be_true(b.ugt(0))
+            futures = [executor.submit(query) for i in range(6)]
+            for f in futures:
+                self.assertEqual(f.result(timeout=60), None)
+        finally:
+            executor.close()
+
+    def testSolver_unsat_core(self):
+        s = Solver(self.engine)
+        a = s.mkBitVec(32)
+        b = s.mkBitVec(32)
+        s.add(b.ult(100))
+        s.add(a.ugt(10))
+        s.add(a.ugt(20))
+        self.assertEqual(s.unsat_core(), None)
+        s.push()
+        s.add(a.ult(5))
+        core = s.unsat_core()
+        self.assertTrue(set(map(str, core)) <= set(map(str, s._constraints)))
+        self.assertFalse(str(b.ult(100)) in map(str, core))
+        core = s.unsat_core(minimize=True)
+        self.assertEqual(len(core), 2)
+        self.assertTrue(str(a.ult(5)) in map(str, core))
+        #the live engine still holds the state
+        self.assertEqual(s.check(), 'unsat')
+        s.pop()
+        self.assertEqual(s.check(), 'sat')
+        self.assertFalse(s.contains_core(core))
+        s1 = pickle.loads(pickle.dumps(s))
+        s1.add(s1._declarations[a.value].ult(5))
+        self.assertTrue(s1.contains_core(core))
+        self.assertFalse(s1.contains_core([]))
+        self.assertFalse(s1.contains_core(None))
+        #no constraint explains a constant False
+        s.add(False)
+        self.assertEqual(s.check(), 'unsat')
+        self.assertEqual(s.unsat_core(), None)
+
+    def testSolver_simplify_cache(self):
+        s = Solver(self.engine)
+        a = s.mkBitVec(32)
+        x = a + 1
+        misses = s.simplify_stats['misses']
+        self.assertEqual((a + 1).value, x.value)
+        self.assertEqual(s.simplify_stats['misses'], misses)
+        self.assertTrue(s.simplify_stats['hits'] > 0)
+        #a name handed out again after a pop is not mistaken for the old one
+        s.push()
+        b = s.mkBitVec(8)
+        y = ~b
+        s.pop()
+        c = s.mkBitVec(16)
+        self.assertEqual(c.value, b.value)
+        z = ~c
+        self.assertEqual(z.size, 16)
+        s.add(z == 0x1234)
+        self.assertEqual(s.getvalue(c), 0xedcb)
+        s.simplify_cache_size = 2
+        for i in range(4):
+            a * (i + 3)
+        self.assertTrue(s.simplify_stats['evictions'] > 0)
+        self.assertTrue(len(s._simplified) <= 2)
+        s1 = pickle.loads(pickle.dumps(s))
+        self.assertEqual(s1.simplify_stats['hits'], 0)
+
+    def testSolver_lazy_simplify(self):
+        s = Solver(self.engine)
+        s.lazy_simplify = True
+        a = s.mkBitVec(32)
+        #single values by construction are folded without the engine
+        self.assertEqual(a.cast(1) + 2, 3)
+        x = ((a + 1) + 2) * 3
+        self.assertEqual(s.simplify_stats['misses'], 0)
+        self.assertTrue(isinstance(x, BitVec))
+        #asserting it simplifies the whole term at once
+        s.add(x == 30)
+        self.assertEqual(s.simplify_stats['misses'], 1)
+        self.assertEqual(s.getvalue(a), 7)
+        s.add(a == a)
+        self.assertEqual(len(s._constraints), 1)
+        #a term past the budget is simplified and named
+        for i in range(40):
+            x = x + a
+        self.assertTrue(len(x.value) <= s.lazy_simplify_size)
+        self.assertTrue(s.simplify_stats['misses'] > 1)
+        #results folded to python constants are returned as they are
+        self.assertEqual(a ^ a, 0)
+        b = s.mkBitVec(32)
+        s.push()
+        s.add(b == 5)
+        self.assertEqual(3 * b, 15)
+        s.pop()
+
+    def testSolver_add_normalize(self):
+        s = Solver(self.engine)
+        a = s.mkBitVec(32)
+        b = s.mkBitVec(32)
+        s.add(a.ugt(5) & b.ult(3))
+        self.assertEqual(s.constraints, ['(assert (bvugt V #x00000005))', '(assert (bvult V_1 #x00000003))'])
+        self.assertEqual(s.check(), 'sat')
+        #nothing new, the status is kept
+        s.add(a.ugt(5))
+        s.add(Bool('true', solver=s))
+        self.assertEqual(s._status, 'sat')
+        self.assertEqual(len(s.constraints), 2)
+        s.push()
+        s.add(a == 1)
+        self.assertEqual(s._status, 'unsat')
+        s.pop()
+        s.push()
+        s.add(b != 7)
+        s.add(b == 7)
+        self.assertEqual(s._status, 'unsat')
+        s.pop()
+        self.assertEqual(s.check(), 'sat')
+        s1 = pickle.loads(pickle.dumps(s))
+        self.assertEqual(s1.constraints, s.constraints)
+
+    def testSolver_pinned(self):
+        s = Solver(self.engine)
+        a = s.mkBitVec(32)
+        b = s.mkBitVec(32)
+        s.push()
+        s.add(a == 0x41)
+        #terms over a pinned symbol fold to python ints
+        self.assertEqual(a + 1, 0x42)
+        self.assertEqual((a * 2) ^ 0x80, 2)
+        self.assertTrue('#x00000041' in (b + a).value)
+        self.assertTrue('#x00000041' in b.ult(a).value)
+        self.assertEqual(s.check(), 'sat')
+        #the engine is not asked
+        sent = []
+        s._send = sent.append
+        self.assertEqual(s.getvalue(a), 0x41)
+        del s._send
+        self.assertEqual(sent, [])
+        s.pop()
+        self.assertTrue(isinstance(a + 1, BitVec))
+
+    def testSolver_can_be_true(self):
+        s = Solver(self.engine)
+        a = s.mkBitVec(32)
+        s.add(a.ugt(5))
+        for assuming in (True, False):
+            s._supported = dict(s._supported, **{'check-sat-assuming': assuming})
+            constraints = s.constraints
+            self.assertTrue(s.can_be_true(a == 6))
+            self.assertFalse(s.can_be_true(a == 5))
+            self.assertTrue(s.must_be_true(a != 5))
+            self.assertFalse(s.must_be_true(a != 6))
+            self.assertTrue(s.can_be_true(True))
+            self.assertFalse(s.must_be_true(False))
+            #the state is left as it was
+            self.assertEqual(s.constraints, constraints)
+            self.assertEqual(s.check(), 'sat')
+            self.assertTrue(s.getvalue(a) > 5)
+        s.add(a == 5)
+        self.assertFalse(s.can_be_true(a == 6))
+        self.assertTrue(s.must_be_true(a == 6))
+
+    def testSolver_feasible(self):
+        s = Solver(self.engine)
+        a = s.mkBitVec(32)
+        b = s.mkBitVec(32)
+        s.add(a.ult(10))
+        s.add(b == a + 1)
+        conds = [a.ult(i) for i in range(1, 20)] + [b == 5, b == 5, a == 10, False, True]
+        expected = [True] * 19 + [True, True, False, False, True]
+        for assuming in (True, False):
+            s._supported = dict(s._supported, **{'check-sat-assuming': assuming})
+            constraints = s.constraints
+            self.assertEqual(s.feasible(conds), expected)
+            self.assertEqual(s.constraints, constraints)
+        #one model decides all the conditions true in it
+        send = s._send
+        sent = []
+        s._send = lambda cmd: (sent.append(cmd), send(cmd))
+        self.assertEqual(s.feasible([a.ult(10 + i) for i in range(5)]), [True] * 5)
+        del s._send
+        self.assertEqual(len([cmd for cmd in sent if cmd.startswith('(check-sat')]), 1)
+        s.add(a == 10)
+        self.assertEqual(s.feasible(conds), [False] * len(conds))
+
+    def testSolver_recycle(self):
+        s = Solver(self.engine)
+        s.recycle_queries = 3
+        a = s.mkBitVec(32)
+        s.add(a.ugt(5))
+        backend = s._backend
+        for i in range(6, 12):
+            s.push()
+            s.add(a.ugt(i))
+            self.assertEqual(s.check(), 'sat')
+            self.assertTrue(s.getvalue(a) > i)
+        #the pushed frames made it to the new engine
+        for i in range(6):
+            s.pop()
+        self.assertEqual(s.check(), 'sat')
+        self.assertTrue(s.recycle_stats['queries'] >= 2)
+        self.assertTrue(s._backend is not backend)
+        self.assertTrue(s.engine_stats['queries'] <= 3)
+        self.assertTrue(s.engine_stats['time'] >= 0)
+        s.recycle_queries = None
+        if s._backend.rss() is not None:
+            self.assertTrue(s._backend.rss() > 0)
+            s.recycle_rss = 1
+            s.add(a.ugt(6))
+            self.assertEqual(s.check(), 'sat')
+            self.assertEqual(s.recycle_stats['rss'], 1)
+
+    def testSolver_engine_limits(self):
+        if not issubclass(Solver._config[self.engine]['backend'], SubprocessBackend):
+            return
+        limit = 1 << 34
+        SubprocessBackend.limits = {resource.RLIMIT_AS: (limit, limit)}
+        try:
+            s = Solver(self.engine)
+        finally:
+            SubprocessBackend.limits = None
+        a = s.mkBitVec(32)
+        s.add(a == 3)
+        self.assertEqual(s.check(), 'sat')
+        limits = open('/proc/%d/limits'%s._backend._proc.pid).read()
+        self.assertTrue(str(limit) in limits)
+
+    def testSolver_dump(self):
+        import StringIO
+        s = Solver(self.engine)
+        a = s.mkBitVec(32)
+        s.add(a.ugt(5))
+        f = StringIO.StringIO()
+        s.dump(f)
+        self.assertEqual(f.getvalue(), str(s))
+        self.assertEqual(str(s), '(declare-fun V () (_ BitVec 32))\n(assert (bvugt V #x00000005))\n')
+
+    def testSymbol_compact(self):
+        s = Solver(self.engine)
+        a = s.mkBitVec(32)
+        b = a + 1
+        self.assertFalse(hasattr(b, '__dict__'))
+        #constants are interned per solver and share its back-reference
+        self.assertTrue(a.cast(1) is b.cast(0x100000001))
+        self.assertTrue(ITEBV(32, a == 0, 1, 2).value.endswith('#x00000001 #x00000002)'))
+        self.assertTrue(b._solver is a._solver)
+        self.assertFalse(Solver(self.engine).mkBitVec(32).cast(1) is a.cast(1))
+        self.assertEqual(a.cast(1).bounds, (1, 1))
+        b1 = pickle.loads(pickle.dumps(b))
+        self.assertEqual(b1.value, b.value)
+        self.assertEqual(b1.bounds, b.bounds)
+
+    def testBitVec_bounds(self):
+        s = Solver(self.engine)
+        a = s.mkBitVec(32)
+        c = s.mkBitVec(8)
+        self.assertEqual(a.bounds, (0, 0xffffffff))
+        z = ZEXTEND(c, 32)
+        self.assertEqual(z.bounds, (0, 0xff))
+        self.assertTrue(UGT(z, 0xff) is False)
+        self.assertTrue(ULT(z, 0x100) is True)
+        self.assertTrue(UGE(0x100, z) is True)
+        self.assertEqual((a & 0xff).bounds, (0, 0xff))
+        self.assertEqual((a | 0x10).bounds, (0x10, 0xffffffff))
+        self.assertEqual(EXTRACT(a, 8, 8).bounds, (0, 0xff))
+        self.assertEqual((z + 1).bounds, (1, 0x100))
+        self.assertEqual((z >> 4).bounds, (0, 0xf))
+        self.assertEqual(CONCAT(8, 1, c).bounds, (0x100, 0x1ff))
+        #undecided comparisons still build a term
+        self.assertTrue(isinstance(ULT(z, 0x10), Bool))
+
+    def testSolver_bounds(self):
+        s = Solver(self.engine)
+        a = s.mkBitVec(32)
+        b = s.mkBitVec(32)
+        s.add(a.ult(10))
+        self.assertEqual(a.bounds, (0, 9))
+        self.assertTrue(UGT(a, 9) is False)
+        self.assertEqual(s.max(a), 9)
+        s.push()
+        s.add(a.uge(9))
+        self.assertEqual(s.minmax(a), (9, 9))
+        s.pop()
+        self.assertEqual(a.bounds, (0, 9))
+        s.add(b == 5)
+        self.assertEqual(s.minmax(b), (5, 5))
+        s1 = pickle.loads(pickle.dumps(s))
+        self.assertEqual(s1._declarations[a.value].bounds, (0, 9))
+        #an empty interval is unsat without asking the engine
+        s.add(ULT(10, a) == False)
+        s.add(a.ugt(20))
+        self.assertEqual(s._status, 'unsat')
+        self.assertEqual(s.check(), 'unsat')
+
+    def testSolver_capabilities(self):
+        probes = []
+        def probe(config):
+            probes.append(config)
+            return real(config)
+        real, smtlib._probe = smtlib._probe, probe
+        probed, Solver._capabilities = Solver._capabilities, {}
+        try:
+            s = Solver(self.engine)
+            self.assertEqual(len(probes), 1)
+            self.assertTrue(s.version)
+            self.assertTrue(s._supports('reset'))
+            self.assertTrue(s._supports('check-sat-assuming'))
+            #another process finds the probe on disk
+            Solver._capabilities = {}
+            self.assertEqual(Solver.capabilities(self.engine), s._supported)
+            self.assertEqual(len(probes), 1)
+            a = s.mkBitVec(32)
+            s.add(a.ult(100))
+            s.add(a != 99)
+            self.assertEqual(s.max(a), 98)
+            self.assertEqual(s.min(a), 0)
+        finally:
+            smtlib._probe = real
+            Solver._capabilities = probed
+
+    def testProbe_version(self):
+        class Unquoted(Backend):
+            def start(self):
+                self._lines = []
+            def stop(self):
+                pass
+            def send(self, cmd):
+                if cmd.startswith('(get-info'):
+                    self._lines.append('(:version 4.8)\n')
+            def _readline(self):
+                return self._lines.pop(0) if self._lines else ''
+        capabilities = smtlib._probe({'backend': Unquoted, 'init': []})
+        self.assertEqual(capabilities['version'], None)
+        self.assertTrue(capabilities['reset'])
+
+    def testSolver_logic(self):
+        s = Solver(self.engine)
+        self.assertEqual(s._logic, 'QF_BV')
+        a = s.mkBitVec(32)
+        s.add(a.ult(10))
+        self.assertEqual(s._logic, 'QF_BV')
+        s.push()
+        #declaring an array restarts the engine with a wider logic
+        array = s.mkArray(32)
+        self.assertEqual(s._logic, 'QF_ABV')
+        s.add(array[a] == 1)
+        self.assertEqual(s.check(), 'sat')
+        s.add(a == 10)
+        self.assertEqual(s.check(), 'unsat')
+        s.pop()
+        self.assertEqual(s.check(), 'sat')
+        #a restarted state gets the narrowest logic again
+        s1 = pickle.loads(pickle.dumps(s))
+        self.assertEqual(s1._logic, 'QF_BV')
+        s2 = Solver(self.engine)
+        b = s2.mkBool()
+        s2.add(b == True)
+        s2 = pickle.loads(pickle.dumps(s2))
+        self.assertEqual(s2._logic, 'QF_UF')
+        self.assertEqual(s2.check(), 'sat')
+
+    def testSolver_sharedterms(self):
+        s = Solver(self.engine)
+        array = s.mkArray(32)
+        key = s.mkBitVec(32)
+        for i in range(20):
+            array[key+i] = i
+        s.push()
+        s.add(array[key+3] == 3)
+        self.assertEqual(s.check(), 'sat')
+        s.pop()
+        #names defined inside the popped frame are gone from the engine
+        s.add(array[key+3] == 4)
+        self.assertEqual(s.check(), 'unsat')
+        self.checkLeak(s)
+
+    def testSharedTerms_rewrite(self):
+        shared = SharedTerms(min_size=10)
+        sorts = {'a': 32, 'b': 32}
+        term = '(bvmul (bvadd a b) (bvadd a b))'
+        cmd = shared.rewrite('(assert (= a %s))'%term, sorts.get)
+        self.assertEqual(cmd, '(define-fun share!1 () (_ BitVec 32) (bvadd a b))\n'
+                              '(assert (= a (bvmul share!1 share!1)))')
+        #seen before, defined now
+        cmd = shared.rewrite('(assert (= b %s))'%term, sorts.get)
+        self.assertEqual(cmd, '(define-fun share!2 () (_ BitVec 32) (bvmul share!1 share!1))\n'
+                              '(assert (= b share!2))')
+        self.assertEqual(shared.rewrite('(get-value (%s))'%term, sorts.get), '(get-value (%s))'%term)
+        #nothing is named under a let
+        cmd = '(assert (let ((a!1 (bvadd a b))) (= a!1 (bvadd a b))))'
+        self.assertEqual(shared.rewrite(cmd, sorts.get), cmd)
+
+    def testSharedTerms_replay(self):
+        shared = SharedTerms(min_size=10)
+        sorts = {'a': 32, 'b': 32}
+        cmd = shared.rewrite('(declare-fun a () (_ BitVec 32))\n(declare-fun b () (_ BitVec 32))\n'
+                             '(assert (= a (bvadd a b)))\n(assert (= b (bvadd a b)))', sorts.get)
+        #defined once declared, right before its first use
+        self.assertEqual(cmd, '(declare-fun a () (_ BitVec 32))\n(declare-fun b () (_ BitVec 32))\n'
+                              '(define-fun share!1 () (_ BitVec 32) (bvadd a b))\n'
+                              '(assert (= a share!1))\n(assert (= b share!1))')
+        #a state repeating a big subterm is replayed in one chunk
+        s = Solver(self.engine)
+        a = s.mkBitVec(32)
+        b = s.mkBitVec(32)
+        term = (a * 3 + b * 5) ^ (a * 7 - b * 11)
+        self.assertTrue(len(term.value) >= 64)
+        s.add(term.ugt(10))
+        s.add(term.ult(100))
+        self.assertEqual(s.check(), 'sat')
+        value = s.getvalue(a)
+        s1 = pickle.loads(pickle.dumps(s))
+        self.assertEqual(s1.check(), 'sat')
+        s1.add(s1._declarations[a.value] == value)
+        self.assertEqual(s1.check(), 'sat')
+        s._restart()
+        self.assertEqual(s.check(), 'sat')
+
+    def testSharedTerms_overflow(self):
+        shared = SharedTerms(min_size=10, max_nodes=3)
+        sorts = {'a': 32, 'b': 32}
+        shared.push()
+        shared.rewrite('(assert (= a (bvmul (bvadd a b) (bvadd a b))))', sorts.get)
+        shared.push()
+        #over max_nodes: everything is forgotten but the push depth
+        shared.rewrite('(assert (= b (bvmul (bvsub a b) (bvsub a b))))', sorts.get)
+        self.assertTrue(shared._names)
+        shared.pop()
+        self.assertEqual(shared._names, {})
+        self.assertEqual(shared._info, [])
+        shared.pop()
+        self.assertEqual(shared._marks, [])
+
+@unittest.skipIf(smtlib._z3 is None, "z3 python bindings not installed")
+class Z3APIExpressionTest(ExpressionTest):
+    ''' Same tests against z3 loaded in-process '''
+    def setUp(self):
+        super(Z3APIExpressionTest, self).setUp()
+        self.engine = 'z3api'
+
+    def testZ3Backend_unbalanced(self):
+        config = Solver._config['z3api']
+        backend = config['backend'](config)
+        backend.start()
+        #the error message itself has unbalanced parens
+        backend.send('(get-value')
+        self.assertTrue(backend.recv().startswith('(error'))
+        backend.send('(check-sat)')
+        self.assertEqual(backend.recv(), 'sat')
+        backend.stop()
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -0,0 +1,183 @@
+# Copyright (c) 2013, Felipe Andres Manzano
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice,this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the copyright holder nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+from smtlib import *
+from smtlib_memory import *
+import unittest
+import os
+import pickle
+import shutil
+import tempfile
+
+class MemoryTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = Solver.capabilities_cache
+        Solver.capabilities_cache = os.path.join(tempfile.mkdtemp(), 'capabilities')
+        self.solver = Solver()
+        self.memory = Memory(self.solver)
+        self.memory.map(0x1000, 0x2000)
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(Solver.capabilities_cache))
+        Solver.capabilities_cache = self.cache
+
+    def testConcrete(self):
+        m = self.memory
+        self.assertEqual(m.read(0x1000, 4), 0)
+        m.write(0x1ffe, 0x41424344, 4)
+        self.assertEqual(m.read(0x1ffe, 4), 0x41424344)
+        self.assertEqual(m.read(0x1ffe, 4, 'big'), 0x44434241)
+        self.assertEqual(m.read(0x2000, 1), 0x42)
+        self.assertRaises(MemoryException, m.read, 0x2ffe, 4)
+        self.assertRaises(MemoryException, m.write, 0x0, 1, 1)
+
+    def testSymbolicValue(self):
+        m = self.memory
+        value = self.solver.mkBitVec(16)
+        m.write(0x1000, 0x41424344, 4)
+        m.write(0x1001, value, 2)
+        #only the symbolic bytes are terms
+        word = m.read(0x1000, 4)
+        self.assertEqual(word.value.count('#x'), 2)
+        self.solver.add(word == 0x41000044)
+        self.assertEqual(self.solver.getvalue(value), 0)
+        #a concrete write drops the overlay
+        m.write(0x1001, 0x4243, 2)
+        self.assertEqual(m.read(0x1000, 4), 0x41424344)
+
+    def testFork(self):
+        m = self.memory
+        m.write(0x1000, 0x11, 1)
+        other = m.fork()
+        self.assertTrue(other._pages[1] is m._pages[1])
+        other.write(0x1000, 0x22, 1)
+        self.assertEqual(m.read(0x1000, 1), 0x11)
+        self.assertEqual(other.read(0x1000, 1), 0x22)
+        self.assertTrue(other._pages[2] is m._pages[2])
+        m.write(0x1004, 0x33, 1)
+        self.assertEqual(other.read(0x1004, 1), 0)
+
+    def testMapFile(self):
+        f = tempfile.TemporaryFile()
+        f.write('ABCD' * 0x500)
+        f.flush()
+        m = Memory(self.solver)
+        m.map_file(0x10000, f)
+        self.assertTrue(m.mapped(0x11fff))
+        self.assertFalse(m.mapped(0x12000))
+        self.assertEqual(m.read(0x10004, 4, 'big'), 0x41424344)
+        self.assertEqual(m.read(0x113fc, 4, 'big'), 0x41424344)
+        #past the end of the file is zero
+        self.assertEqual(m.read(0x11400, 4), 0)
+        m.write(0x10000, 0x5a, 1)
+        self.assertEqual(m.read(0x10000, 2, 'big'), 0x5a42)
+        f.seek(0)
+        self.assertEqual(f.read(1), 'A')
+        f.close()
+
+    def testSymbolicAddress(self):
+        m = self.memory
+        s = self.solver
+        m.write(0x1000, 0x41424344, 4)
+        address = s.mkBitVec(32)
+        s.add(address.uge(0x1000))
+        s.add(address.ule(0x1003))
+        value = m.read(address, 1)
+        s.push()
+        s.add(value == 0x42)
+        self.assertEqual(s.getvalue(address), 0x1002)
+        s.pop()
+        m.write(address, 0x55, 1)
+        s.add(address == 0x1001)
+        self.assertEqual(s.getvalue(m.read(0x1000, 4)), 0x41425544)
+
+    def testSymbolicAddress_unmapped(self):
+        m = self.memory
+        s = self.solver
+        m.write(0x1007, 0x41, 1)
+        address = s.mkBitVec(32)
+        s.add(address.uge(0xff8))
+        s.add(address.ult(0x1008))
+        value = m.read(address, 1)
+        #the unmapped addresses below 0x1000 do not read the last byte
+        s.push()
+        s.add(value == 0x41)
+        s.add(address == 0xff8)
+        self.assertEqual(s.check(), 'unsat')
+        s.pop()
+        s.add(address.ult(0x1000))
+        self.assertEqual(s.check(), 'unsat')
+
+    def testSymbolicAddress_wide_unmapped(self):
+        s = self.solver
+        m = Memory(s)
+        m.map(0x1000, 0x1000)
+        m.map(0x3000, 0x1000)
+        address = s.mkBitVec(32)
+        s.add(address.uge(0x1000))
+        s.add(address.ult(0x4000))
+        value = m.read(address, 2)
+        s.add(value == 0)
+        s.push()
+        s.add(address.uge(0x2000))
+        s.add(address.ult(0x3000))
+        self.assertEqual(s.check(), 'unsat')
+        s.pop()
+        #the bytes read past the first page are unmapped
+        s.push()
+        s.add(address == 0x1fff)
+        self.assertEqual(s.check(), 'unsat')
+        s.pop()
+        self.assertEqual(s.check(), 'sat')
+        far = s.mkBitVec(32)
+        s.add(far.uge(0x8000))
+        s.add(far.ult(0x9000))
+        self.assertRaises(MemoryException, m.read, far, 1)
+
+    def testSymbolicAddress_wide(self):
+        m = self.memory
+        s = self.solver
+        m.write(0x1800, 0x41, 1)
+        address = s.mkBitVec(32)
+        s.add(address.ult(0x4000))
+        value = m.read(address, 1)
+        s.add(value == 0x41)
+        self.assertEqual(s.getvalue(address), 0x1800)
+
+    def testPickle(self):
+        m = self.memory
+        value = self.solver.mkBitVec(8)
+        m.write(0x1000, value, 1)
+        m.write(0x1001, 0x41, 1)
+        s, m1 = pickle.loads(pickle.dumps((self.solver, m)))
+        self.assertTrue(m1.solver is s)
+        self.assertEqual(m1.read(0x1001, 1), 0x41)
+        self.assertEqual(m1.read(0x1000, 1).value, value.value)
+
+if __name__ == '__main__':
+    unittest.main()
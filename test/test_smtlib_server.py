@@ -0,0 +1,147 @@
+# Copyright (c) 2013, Felipe Andres Manzano
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice,this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the copyright holder nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+from smtlib import *
+from smtlib_server import *
+import smtlib_server
+import unittest
+import fcntl
+import resource
+import gc
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+
+class ServerTest(unittest.TestCase):
+    def get_open_fds(self):
+        fds = []
+        for fd in range(3, resource.RLIMIT_NOFILE):
+            try:
+                flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+            except IOError:
+                continue
+            fds.append(fd)
+        return fds
+
+    def setUp(self):
+        self.fds = self.get_open_fds()
+        self.tmp = tempfile.mkdtemp()
+        self.address = os.path.join(self.tmp, 'smtlib.sock')
+        self.cache = Solver.capabilities_cache
+        Solver.capabilities_cache = os.path.join(self.tmp, 'capabilities')
+        self.server = make_server(self.address, processes=2)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        Solver.capabilities_cache = self.cache
+        shutil.rmtree(self.tmp)
+        gc.collect()
+        self.assertEqual(self.fds, self.get_open_fds())
+
+    def testRemoteSolver(self):
+        s = RemoteSolver(self.address)
+        a = s.mkBitVec(32)
+        b = s.mkBitVec(32)
+        s.add(a.ult(10))
+        s.add(b == a + 1)
+        self.assertEqual(s.check(), 'sat')
+        self.assertEqual(s.max(b), 10)
+        s.push()
+        s.add(a == 11)
+        self.assertEqual(s.check(), 'unsat')
+        s.pop()
+        self.assertEqual(s.check(), 'sat')
+
+    def testRemoteSolver_pickle(self):
+        s = RemoteSolver(self.address)
+        a = s.mkBitVec(32)
+        s.add(a.ugt(1000))
+        s1 = pickle.loads(pickle.dumps(s))
+        self.assertTrue(isinstance(s1, RemoteSolver))
+        s1.add(s1.declarations[0] == 1001)
+        self.assertEqual(s1.check(), 'sat')
+        s.add(a == 5)
+        self.assertEqual(s.check(), 'unsat')
+        #both states live in the same engines
+        self.assertEqual(self.server.schedulers.keys(), ['z3'])
+
+    def testRemoteSolver_error(self):
+        s = RemoteSolver(self.address)
+        a = s.mkBitVec(32)
+        s._send('(assert (= nosuchsymbol #x00000000))')
+        self.assertRaises(Exception, s.check)
+        #the state is replayed and the engine keeps working
+        s.add(a == 1)
+        self.assertEqual(s.check(), 'sat')
+
+    def testRemoteSolver_stray_recv(self):
+        sock = smtlib_server._connect(self.address)
+        try:
+            sock.sendall(smtlib_server._frame('H', 'z3'))
+            sock.sendall(smtlib_server._frame('R'))
+            kind, payload = smtlib_server._recvframe(sock)
+            self.assertEqual(kind, 'E')
+        finally:
+            sock.close()
+        #the engines are still handed out as usual
+        self.assertFalse(None in self.server.schedulers['z3']._free)
+        s = RemoteSolver(self.address)
+        a = s.mkBitVec(32)
+        s.add(a.ugt(1))
+        self.assertTrue(s.getvalue(a) > 1)
+
+    def testRemoteSolver_threads(self):
+        #more clients than engines, each must read its own responses
+        wrong = []
+        def client(n):
+            s = RemoteSolver(self.address)
+            a = s.mkBitVec(32)
+            s.add(a == n)
+            for i in range(20):
+                if s.getvalue(a) != n:
+                    wrong.append(n)
+                s.push()
+                s.add(a == n + 1)
+                if s.check() != 'unsat':
+                    wrong.append(n)
+                s.pop()
+        threads = [threading.Thread(target=client, args=(n,)) for n in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(wrong, [])
+
+if __name__ == '__main__':
+    unittest.main()
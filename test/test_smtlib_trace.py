@@ -0,0 +1,144 @@
+# Copyright (c) 2013, Felipe Andres Manzano
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice,this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the copyright holder nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+from smtlib import *
+from smtlib_trace import *
+import smtlib
+import smtlib_trace
+import unittest
+import os
+import shutil
+import tempfile
+
+class TraceTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.trace = os.path.join(self.tmp, 'run.trace')
+        self.cache = Solver.capabilities_cache
+        Solver.capabilities_cache = os.path.join(self.tmp, 'capabilities')
+
+    def tearDown(self):
+        Solver.recorder = None
+        Solver.capabilities_cache = self.cache
+        shutil.rmtree(self.tmp)
+
+    def record(self):
+        Solver.recorder = recorder = Recorder(self.trace)
+        s = Solver()
+        a = s.mkBitVec(32)
+        b = s.mkBitVec(32)
+        s.add(a.ult(10))
+        s.add(b == a + 1)
+        self.assertEqual(s.check(), 'sat')
+        self.assertEqual(s.getvalue(b), s.getvalue(a) + 1)
+        s.push()
+        s.add(a == b)
+        self.assertEqual(s.check(), 'unsat')
+        s.pop()
+        Solver.recorder = None
+        del s
+        recorder.close()
+
+    def testRecord(self):
+        self.record()
+        records = list(smtlib_trace.read(self.trace))
+        self.assertEqual(records[0][:2], ('S', 1))
+        self.assertEqual(records[0][3], 'z3')
+        kinds = [kind for kind, _, _, _ in records]
+        self.assertEqual(kinds.count('S'), 1)
+        self.assertTrue(kinds.count('R') >= 3)
+        responses = [payload for kind, _, _, payload in records if kind == 'R']
+        self.assertTrue('unsat' in responses)
+        #appending opens new sessions in the same file
+        self.record()
+        sessions = [session for kind, session, _, _ in smtlib_trace.read(self.trace) if kind == 'S']
+        self.assertEqual(sessions, [1, 2])
+
+    def testRecord_restart(self):
+        Solver.recorder = recorder = Recorder(self.trace)
+        s = Solver()
+        a = s.mkBitVec(32)
+        s.add(a == 3)
+        self.assertEqual(s.check(), 'sat')
+        #a reset engine keeps its session
+        s._restart()
+        self.assertEqual(s.check(), 'sat')
+        Solver.recorder = None
+        recorder.close()
+        starts = [(kind, session) for kind, session, _, _ in smtlib_trace.read(self.trace) if kind == 'S']
+        self.assertEqual(starts, [('S', 1), ('S', 1)])
+        results = replay(self.trace)
+        self.assertEqual([r['query'] for r in results], ['(check-sat)', '(check-sat)'])
+        self.assertEqual(summary(results)['mismatches'], 0)
+
+    def testRecord_unsat_core(self):
+        Solver.recorder = recorder = Recorder(self.trace)
+        s = Solver()
+        a = s.mkBitVec(32)
+        s.add(a == 3)
+        s.add(a == 4)
+        self.assertEqual(len(s.unsat_core()), 2)
+        Solver.recorder = None
+        recorder.close()
+        starts = [(session, payload) for kind, session, _, payload in smtlib_trace.read(self.trace) if kind == 'S']
+        self.assertEqual(starts, [(1, 'z3'), (2, 'z3 unsat-core')])
+        results = replay(self.trace)
+        self.assertTrue('(get-unsat-core)' in [r['query'] for r in results])
+        self.assertEqual(summary(results)['mismatches'], 0)
+
+    def testRecord_compressed(self):
+        recorder = Recorder(self.trace)
+        s = Solver()
+        big = '(assert %s)'%' '.join(['true']*1000)
+        recorder.sent(s, big)
+        recorder.close()
+        records = list(smtlib_trace.read(self.trace))
+        self.assertEqual(records[1][0], 'C')
+        self.assertEqual(records[1][3], big)
+        self.assertTrue(os.path.getsize(self.trace) < len(big))
+
+    def testReplay(self):
+        self.record()
+        results = replay(self.trace)
+        self.assertTrue(len(results) >= 3)
+        self.assertEqual(summary(results)['mismatches'], 0)
+        for r in results:
+            self.assertTrue(r['latency'] >= 0)
+            self.assertTrue(r['recorded'] >= 0)
+
+    @unittest.skipIf(smtlib._z3 is None, "z3 python bindings not installed")
+    def testReplay_engine(self):
+        self.record()
+        results = replay(self.trace, 'z3api')
+        checks = [r for r in results if r['query'] == '(check-sat)']
+        self.assertTrue(checks)
+        for r in checks:
+            self.assertTrue(r['match'])
+
+if __name__ == '__main__':
+    unittest.main()